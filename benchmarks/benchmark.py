@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Copyright (c) 2013--2018, Julien Seguinot <seguinot@vaw.baug.ethz.ch>
+# GNU General Public License v3.0+ (https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""
+Benchmark suite for the positive degree day model.
+
+Build in-memory synthetic climates of configurable size, time each stage of
+the model separately, and report throughput in grid cells per second, peak
+traced memory of each stage, and peak resident memory of the whole run.
+Results can be saved as JSON and compared to those of a previous run, e.g.
+before upgrading pypdd.
+"""
+
+import os
+import sys
+import argparse
+import json
+import time
+import platform
+import importlib
+import resource
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+# import pypdd from this source tree rather than any installed version
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+pypdd = importlib.import_module('pypdd')
+
+
+def make_climate(nx=201, ny=201, nt=12, dtype='f8', stdv='full'):
+    """Return an idealized in-memory climate of given size.
+
+    The climate follows the pattern of `pypdd.make_fake_climate`. Standard
+    deviation of temperature can be 'zero' or 'constant' (scalars),
+    'spatial' (constant in time) or 'full' (time-dependent).
+    """
+
+    # prepare coordinates
+    xx, yy = np.meshgrid(np.linspace(-1, 1, nx), np.linspace(-1, 1, ny),
+                         indexing='ij')
+    cos = np.cos(np.arange(nt)*2*np.pi/nt)[:, None, None]
+
+    # compute temperature and precipitation
+    temp = -10 * yy - 5 * cos
+    prec = xx * (np.sign(xx) - cos)
+
+    # compute standard deviation
+    if stdv == 'zero':
+        stdv = 0.0
+    elif stdv == 'constant':
+        stdv = 2.0
+    elif stdv == 'spatial':
+        stdv = 2 + xx - yy
+    elif stdv == 'full':
+        stdv = (2 + xx - yy) * (1 - cos)
+    else:
+        raise ValueError('unknown stdv pattern %s' % stdv)
+
+    # return arrays in requested type
+    return (temp.astype(dtype), prec.astype(dtype),
+            np.asarray(stdv, dtype=dtype))
+
+
+def peak_rss():
+    """Return peak resident set size of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+
+def timed(stages, name, ncells, function, *args, **kwargs):
+    """Call function, store its timing under name, and return its result.
+
+    If memory allocations are traced, also store the peak memory allocated
+    during the call, including numpy arrays but not netCDF buffers.
+    """
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    stages[name] = {'seconds': seconds,
+                    'cells_per_second': ncells/seconds if seconds else None}
+    if tracemalloc.is_tracing():
+        stages[name]['peak_memory'] = tracemalloc.get_traced_memory()[1]-before
+    return result
+
+
+def run(nx=201, ny=201, nt=12, dtype='f8', stdv='full', repeat=3, nco=True,
+        **parameters):
+    """Run the benchmark and return results in a dictionary.
+
+    Each stage is timed *repeat* times and the fastest run is kept, after a
+    first run tracing peak memory, which also serves as a warm-up.
+    Additional keyword arguments are passed to `pypdd.PDDModel`.
+    """
+
+    # prepare model and climate
+    pdd = pypdd.PDDModel(dtype=dtype, **parameters)
+    temp, prec, stdv_array = make_climate(nx, ny, nt, dtype, stdv)
+    maxshape = temp.shape
+    ncells = nx*ny
+
+    # trace memory of each stage, then time it, keeping the fastest
+    best = {}
+    memory = {}
+    for i in range(repeat+1):
+        stages = {}
+        if i == 0:
+            tracemalloc.start()
+        itemp = timed(stages, 'interpolate', ncells, pdd._interpolate,
+                      pdd._expand(temp, maxshape))
+        iprec = pdd._interpolate(pdd._expand(prec, maxshape))
+        istdv = pdd._interpolate(pdd._expand(stdv_array, maxshape))
+        inst_pdd = timed(stages, 'inst_pdd', ncells, pdd.inst_pdd,
+                         itemp, istdv)
+        accu_rate = timed(stages, 'accu_rate', ncells, pdd.accu_rate,
+                          itemp, iprec)
+        rates = timed(stages, 'snow_depth', ncells, pdd.snow_depth,
+                      accu_rate, inst_pdd)
+        timed(stages, 'integrate', ncells, pdd._integrate, rates[1])
+        timed(stages, 'call', ncells, lambda *args: dict(pdd(*args)),
+              temp, prec, stdv_array)
+
+        # time netcdf input and output
+        if nco:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                infile = os.path.join(tmpdir, 'atm.nc')
+                outfile = os.path.join(tmpdir, 'smb.nc')
+                timed(stages, 'nco_write', ncells, write_climate, infile,
+                      temp, prec, stdv_array)
+                timed(stages, 'nco', ncells, pdd.nco, infile, outfile)
+
+        # keep the memory peak, then the fastest timing of each stage
+        if i == 0:
+            tracemalloc.stop()
+            memory = {name: stage['peak_memory']
+                      for name, stage in stages.items()}
+            continue
+        for name, stage in stages.items():
+            if name not in best or stage['seconds'] < best[name]['seconds']:
+                best[name] = dict(stage, peak_memory=memory[name])
+
+    # return results and metadata
+    return {'config': dict(nx=nx, ny=ny, nt=nt, dtype=dtype, stdv=stdv,
+                           repeat=repeat, **parameters),
+            'system': {'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'pypdd': os.path.abspath(pypdd.__file__)},
+            'stages': best,
+            'peak_rss': peak_rss()}
+
+
+def write_climate(filename, temp, prec, stdv):
+    """Write an in-memory climate to a netCDF file read by `PDDModel.nco`."""
+    import netCDF4 as nc4
+    ods = nc4.Dataset(filename, 'w')
+    ods.createDimension('time', temp.shape[0])
+    ods.createDimension('x', temp.shape[1])
+    ods.createDimension('y', temp.shape[2])
+    for varname, array in zip(('temp', 'prec', 'stdv'), (temp, prec, stdv)):
+        var = pypdd._create_nc_variable(ods, varname, 'f4', ('time', 'x', 'y'))
+        var[:] = np.broadcast_to(array, temp.shape)
+    ods.close()
+
+
+def report(results, reference=None):
+    """Print a table of stage timings, compared to a reference if given."""
+    print('%-12s %12s %16s %12s %12s' % ('stage', 'seconds', 'cells/second',
+                                         'peak MiB',
+                                         'speedup' if reference else ''))
+    for name, stage in results['stages'].items():
+        line = '%-12s %12.6f %16.0f %12.1f' % (
+            name, stage['seconds'], stage['cells_per_second'] or 0,
+            stage['peak_memory']/2**20)
+        if reference and name in reference['stages']:
+            line += ' %12.2f' % (reference['stages'][name]['seconds'] /
+                                 stage['seconds'])
+        print(line)
+    print('peak resident memory: %.1f MiB' % (results['peak_rss']/2**20))
+
+
+def main():
+    """Main program for command-line execution."""
+
+    # parse arguments
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Python Positive Degree Day (PDD) model.')
+    parser.add_argument('--size', type=int, metavar=('NX', 'NY'), nargs=2,
+                        help='grid size (default 201 201)', default=(201, 201))
+    parser.add_argument('--nt', type=int, metavar='N',
+                        help='number of input time steps (default 12)',
+                        default=12)
+    parser.add_argument('--dtype', help='floating-point type (default f8)',
+                        default='f8', choices=('f4', 'f8'))
+    parser.add_argument('--stdv', help='standard deviation pattern '
+                                       '(default full)', default='full',
+                        choices=('zero', 'constant', 'spatial', 'full'))
+    default = pypdd.PARAMETERS['interpolate_n']
+    parser.add_argument('--interpolate-n', type=int, metavar='N',
+                        help='number of points used in interpolations '
+                             '(default %s)' % default, default=default)
+    parser.add_argument('--repeat', type=int, metavar='N',
+                        help='number of repetitions (default 3)', default=3)
+    parser.add_argument('--no-nco', action='store_true',
+                        help='skip netCDF input and output benchmarks')
+    parser.add_argument('-o', '--output', metavar='results.json',
+                        help='save results as JSON')
+    parser.add_argument('-c', '--compare', metavar='reference.json',
+                        help='compare results to a previous JSON output')
+    args = parser.parse_args()
+
+    # run benchmark
+    results = run(nx=args.size[0], ny=args.size[1], nt=args.nt,
+                  dtype=args.dtype, stdv=args.stdv, repeat=args.repeat,
+                  nco=not args.no_nco, interpolate_n=args.interpolate_n)
+
+    # load reference and report
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+    report(results, reference)
+
+    # save results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
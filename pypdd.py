@@ -6,6 +6,25 @@
 A positive degree day model for glacier surface mass balance
 """
 
+import argparse
+import collections
+import collections.abc
+import contextlib
+import copy
+import functools
+import hashlib
+import itertools
+import json
+import math
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 import numpy as np
 # comment
 
@@ -21,7 +40,19 @@ PARAMETERS = {
     'temp_snow':        0.0,
     'temp_rain':        2.0,
     'interpolate_rule': 'linear',
-    'interpolate_n':    52}
+    'interpolate_n':    52,
+    'solver':           'loop',
+    'tile_size':        None,
+    'inst_pdd_method':  'exact',
+    'inst_pdd_tolerance': 1e-6,
+    'dtype':            'f8',
+    'cache_size':       0,
+    'integration':      'sampled',
+    'backend':          'numpy',
+    'spinup':           None,
+    'spinup_tolerance': 1e-6,
+    'spinup_iterations': 50,
+    'scratch_dir':      None}
 
 
 # Default variable attributes
@@ -82,6 +113,9 @@ ATTRIBUTES = {
     'runoff': {
         'long_name': 'cumulative ice-equivalent surface meltwater runoff',
         'units':     'm yr-1'},
+    'final_snow_depth': {
+        'long_name': 'depth of snow cover at the end of the year',
+        'units':     'm'},
 
     # instantaneous quantities
     'inst_pdd': {
@@ -110,6 +144,17 @@ ATTRIBUTES = {
         'units':     'm'}}
 
 
+# Output variable names
+# ---------------------
+
+INSTANTANEOUS = ('temp', 'prec', 'stdv', 'inst_pdd', 'accu_rate',
+                 'snow_melt_rate', 'ice_melt_rate', 'melt_rate', 'runoff_rate',
+                 'inst_smb', 'snow_depth')
+
+CUMULATIVE = ('pdd', 'accu', 'snow_melt', 'ice_melt', 'melt', 'runoff', 'smb',
+              'final_snow_depth')
+
+
 def _create_nc_variable(dataset, varname, dtype, dimensions):
     """Create netCDF variable and apply default attributes"""
     var = dataset.createVariable(varname, dtype, dimensions)
@@ -118,6 +163,377 @@ def _create_nc_variable(dataset, varname, dtype, dimensions):
     return var
 
 
+def _compact(array):
+    """Collapse broadcast (zero-stride) dimensions of an array to length one"""
+    return array[tuple(slice(0, 1) if stride == 0 else slice(None)
+                       for stride in array.strides)]
+
+
+def _array_key(array):
+    """Return a hashable key identifying array shape and content"""
+    compact = np.ascontiguousarray(_compact(array))
+    digest = hashlib.blake2b(compact.data.cast('B'), digest_size=16)
+    return (array.shape, array.dtype.str, digest.hexdigest(),
+            tuple(stride == 0 for stride in array.strides))
+
+
+def _weighted_sum(weights, array):
+    """Apply weights to the first axis of an array, skipping zero weights"""
+    result = np.empty((len(weights),)+array.shape[1:],
+                      dtype=np.result_type(weights, array))
+    term = np.empty_like(result[0])
+    for row, out in zip(weights, result):
+        first, *others = np.flatnonzero(row)
+        np.multiply(row[first], array[first], out=out)
+        for k in others:
+            np.multiply(row[k], array[k], out=term)
+            out += term
+    return result
+
+
+def _shared_array(shape, dtype, name=None):
+    """Create or attach an array in shared memory, return segment and array"""
+    size = max(int(np.prod(shape))*np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _run_shared(model, inputs, outputs, maxshape, tile):
+    """Run model on one tile of shared memory arrays (in a worker process)"""
+    segments = []
+    arrays = {}
+    for key, spec in list(enumerate(inputs)) + list(outputs.items()):
+        if isinstance(spec, tuple):
+            shm, arrays[key] = _shared_array(*spec[1:], name=spec[0])
+            segments.append(shm)
+        else:
+            arrays[key] = spec
+    model._run_tiles([arrays[i] for i in range(len(inputs))], maxshape,
+                     [tile], {key: arrays[key] for key in outputs},
+                     outputs=list(outputs))
+    del arrays
+    for shm in segments:
+        shm.close()
+
+
+def _batch_init(model):
+    """Store a model in a worker process for batch runs"""
+    global _BATCH_MODEL  # pylint: disable=global-variable-undefined
+    _BATCH_MODEL = model
+
+
+def _batch_run(input_file, output_file, kwargs, model=None):
+    """Run netCDF operator on one file and return status (in a worker)"""
+    model = model or _BATCH_MODEL
+    start = time.perf_counter()
+    try:
+        model.nco(input_file, output_file, **kwargs)
+        error = None
+    except Exception as err:  # pylint: disable=broad-except
+        error = '%s: %s' % (type(err).__name__, err)
+    return input_file, output_file, error, time.perf_counter() - start
+
+
+class _Pipeline():
+    """Read items and write results in background threads.
+
+    Items are read from an iterable in a reader thread and results written
+    in a writer thread, through queues of *size* items, while the calling
+    thread computes. Time spent waiting on the queues is reported to hooks.
+    The first error in either thread stops the pipeline and is raised in
+    the calling thread. If *size* is zero, items are read and results
+    written in the calling thread.
+    """
+
+    def __init__(self, items, write, size=2, hooks=()):
+        self.items = iter(items)
+        self.write = write
+        self.size = size
+        self.hooks = hooks
+        self.inqueue = queue.Queue(size)
+        self.outqueue = queue.Queue(size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.threads = [threading.Thread(target=self._produce, daemon=True),
+                        threading.Thread(target=self._consume, daemon=True)]
+
+    def __enter__(self):
+        if self.size:
+            for thread in self.threads:
+                thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop the reader, let the writer finish, and raise its errors"""
+        if not self.size:
+            return
+        self.stop.set()
+        while self.threads[0].is_alive():
+            try:
+                self.inqueue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.outqueue.put(None)
+        self.threads[1].join()
+        if self.errors and exc_type is None:
+            raise self.errors[0]
+
+    def _wait(self, stage, function, *args):
+        """Call a queue method and report waiting time to hooks"""
+        start = time.perf_counter()
+        result = function(*args)
+        for hook in self.hooks:
+            hook(stage, time.perf_counter()-start, 0, [])
+        return result
+
+    def _produce(self):
+        """Read items into the input queue (in the reader thread)"""
+        try:
+            for item in self.items:
+                self._wait('wait_read', self.inqueue.put, item)
+                if self.stop.is_set():
+                    break
+        except Exception as err:  # pylint: disable=broad-except
+            self.inqueue.put(err)
+        if self.errors:
+            self.inqueue.put(self.errors[0])
+
+    def _consume(self):
+        """Write results from the output queue (in the writer thread)"""
+        while True:
+            item = self._wait('wait_write', self.outqueue.get)
+            if item is None:
+                return
+            if not self.errors:
+                try:
+                    self.write(*item)
+                except Exception as err:  # pylint: disable=broad-except
+                    self.errors.append(err)
+                    self.stop.set()
+
+    def get(self):
+        """Return the next item from the reader"""
+        if not self.size:
+            return next(self.items)
+        item = self._wait('wait_compute', self.inqueue.get)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def put(self, *item):
+        """Pass a result to the writer, raise its first error if any"""
+        if not self.size:
+            self.write(*item)
+        elif self.errors:
+            raise self.errors[0]
+        else:
+            self._wait('wait_compute', self.outqueue.put, item)
+
+
+_KERNEL_PARAMS = ('pdd_factor_snow', 'pdd_factor_ice', 'refreeze_snow',
+                  'refreeze_ice', 'temp_snow', 'temp_rain')
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_kernel():
+    """Compile and return a fused cumulative kernel (requires numba)"""
+    import numba
+
+    @numba.njit(inline='always')
+    def value(array, weights, i, col):
+        """Interpolate one input at one time step and column"""
+        indptr, indices, coefs = weights
+        if array.shape[0] == 1:
+            return array[0, col]
+        result = 0.0
+        for k in range(indptr[i], indptr[i+1]):
+            result += coefs[k]*array[indices[k], col]
+        return result
+
+    @numba.njit(parallel=True)
+    def kernel(temp, prec, stdv, snow, weights, params, outputs):
+        """Compute yearly sums for each grid cell"""
+        ddf_snow, ddf_ice = params[0], params[1]
+        refreeze_snow, refreeze_ice = params[2], params[3]
+        temp_snow, temp_rain = params[4], params[5]
+        npts = len(weights[0]) - 1
+        for cell in numba.prange(outputs.shape[1]):
+            snow_depth = snow[0, cell % snow.shape[1]]
+            pdd = accu = snow_melt = ice_melt = melt = runoff = smb = 0.0
+            tcol = cell % temp.shape[1]
+            pcol = cell % prec.shape[1]
+            scol = cell % stdv.shape[1]
+            for i in range(npts):
+
+                # interpolate inputs from non-zero weights, skipping
+                # time-constant ones
+                temp_i = value(temp, weights, i, tcol)
+                prec_i = value(prec, weights, i, pcol)
+                stdv_i = value(stdv, weights, i, scol)
+
+                # compute accumulation and positive degree days
+                snowfrac = min(max((temp_rain-temp_i) /
+                                   (temp_rain-temp_snow), 0.0), 1.0)
+                accu_rate = snowfrac*prec_i
+                if stdv_i > 0:
+                    normtemp = temp_i / (2**0.5*stdv_i)
+                    teff = (stdv_i/(2*math.pi)**0.5*math.exp(-normtemp**2) +
+                            temp_i/2*math.erfc(-normtemp))
+                else:
+                    teff = max(temp_i, 0.0)
+                inst_pdd = teff*365.242198781
+
+                # update snow depth and compute melt and runoff
+                snow_depth += accu_rate
+                pot_snow_melt = ddf_snow*inst_pdd
+                snow_melt_rate = min(snow_depth, pot_snow_melt)
+                ice_melt_rate = (pot_snow_melt-snow_melt_rate)*ddf_ice/ddf_snow
+                snow_depth -= snow_melt_rate
+                melt_rate = snow_melt_rate + ice_melt_rate
+                runoff_rate = (melt_rate - refreeze_snow*snow_melt_rate -
+                               refreeze_ice*ice_melt_rate)
+
+                # update yearly sums
+                pdd += inst_pdd
+                accu += accu_rate
+                snow_melt += snow_melt_rate
+                ice_melt += ice_melt_rate
+                melt += melt_rate
+                runoff += runoff_rate
+                smb += accu_rate - runoff_rate
+
+            # store yearly integrals and final snow depth
+            outputs[0, cell] = pdd/(npts-1)
+            outputs[1, cell] = accu/(npts-1)
+            outputs[2, cell] = snow_melt/(npts-1)
+            outputs[3, cell] = ice_melt/(npts-1)
+            outputs[4, cell] = melt/(npts-1)
+            outputs[5, cell] = runoff/(npts-1)
+            outputs[6, cell] = smb/(npts-1)
+            outputs[7, cell] = snow_depth
+
+    return kernel
+
+
+# Lazy model results
+# ------------------
+
+def _runoff_rate(melt_rate, snow_melt_rate, ice_melt_rate, refreeze_snow=0.0,
+                 refreeze_ice=0.0):
+    """Compute runoff rate from melt rates and refreezing fractions"""
+    return (melt_rate - refreeze_snow * snow_melt_rate
+            - refreeze_ice * ice_melt_rate)
+
+
+def _last(array):
+    """Return the last time step of an array"""
+    return array[-1]
+
+
+class PDDResults(collections.abc.MutableMapping):
+    """Return a mapping of output variables computed on demand.
+
+    Behaves like a dictionary of arrays. Variables given as *fields* are
+    stored as is. Variables given as *recipes*, a dictionary of (function,
+    argument names) tuples, are computed on first access from other
+    variables, including fields and recipes not exposed as keys, and are
+    then stored. Only variables listed in *names* are exposed as keys (by
+    default, all fields and recipes).
+
+    Deleting a variable discards it, as well as any hidden variable no longer
+    needed to compute the remaining ones, so that intermediate fields can be
+    freed as soon as results of interest have been computed. Assigning a
+    variable first computes any variable depending on its former value.
+    Copies share computed variables but compute others separately, and
+    pickling computes all variables.
+    """
+
+    def __init__(self, fields, recipes=None, names=None):
+        self._values = dict(fields)
+        self._recipes = dict(recipes or {})
+        if names is None:
+            names = list(self._values) + list(self._recipes)
+        self._names = list(names)
+        for varname in self._names:
+            if varname not in self._values and varname not in self._recipes:
+                raise KeyError("%s is not a valid variable name" % varname)
+        self._release()
+
+    def __getitem__(self, varname):
+        if varname not in self._names:
+            raise KeyError(varname)
+        return self._evaluate(varname)
+
+    def __setitem__(self, varname, value):
+        for other in list(self._recipes):
+            if other != varname and varname in self._depends(other):
+                self._evaluate(other)
+        self._values[varname] = value
+        self._recipes.pop(varname, None)
+        if varname not in self._names:
+            self._names.append(varname)
+        self._release()
+
+    def __delitem__(self, varname):
+        if varname not in self._names:
+            raise KeyError(varname)
+        self._names.remove(varname)
+        self._release()
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            varname if varname in self._values else varname + '*'
+            for varname in self._names))
+
+    def __getstate__(self):
+        return {'_values': dict(self), '_recipes': {},
+                '_names': list(self._names)}
+
+    def copy(self):
+        """Return a shallow copy."""
+        return type(self)(self._values, self._recipes, names=self._names)
+
+    def computed(self):
+        """Return names of variables already computed."""
+        return [varname for varname in self._names
+                if varname in self._values]
+
+    def _evaluate(self, varname):
+        """Compute variable and its dependencies if needed."""
+        if varname not in self._values:
+            function, args = self._recipes[varname]
+            value = function(*[self._evaluate(arg) for arg in args])
+            self._values[varname] = value
+            del self._recipes[varname]
+            self._release()
+        return self._values[varname]
+
+    def _depends(self, *varnames):
+        """Return names of variables needed to compute given ones."""
+        needed = set()
+        stack = list(varnames)
+        while stack:
+            varname = stack.pop()
+            if varname not in needed:
+                needed.add(varname)
+                if varname not in self._values:
+                    stack.extend(self._recipes[varname][1])
+        return needed
+
+    def _release(self):
+        """Discard variables not needed by exposed ones."""
+        needed = self._depends(*self._names)
+        for store in (self._values, self._recipes):
+            for varname in set(store) - needed:
+                del store[varname]
+
+
 # PDD model class
 # ---------------
 
@@ -144,6 +560,83 @@ class PDDModel():
         Interpolation rule passed to `scipy.interpolate.interp1d`.
     *interpolate_n*: int
         Number of points used in interpolations.
+    *solver*: [ 'loop' | 'cumsum' ]
+        Method used to compute snow depth evolution. If 'loop', step through
+        time explicitly. If 'cumsum', solve the snow depth recursion as the
+        difference between cumulative sums and their running minima. Both
+        write into preallocated output arrays, but 'cumsum' needs more passes
+        over them and is usually slower.
+    *tile_size*: int or tuple of int
+        If set, run the model on spatial tiles of this size one at a time,
+        and write results into preallocated output arrays. This bounds peak
+        memory usage by the tile size rather than the input grid size.
+    *inst_pdd_method*: [ 'exact' | 'table' ]
+        Method used to compute the Calov and Greve (2005) integral. If
+        'exact', evaluate exponential and error functions everywhere. If
+        'table', interpolate a precomputed table of the effective temperature
+        as a function of temperature normalized by its standard deviation.
+    *inst_pdd_tolerance*: float
+        Maximum error of the 'table' method, in units of standard deviation
+        of temperature (i.e. Kelvin per Kelvin of standard deviation).
+    *dtype*: data-type
+        Floating-point type used throughout computations. Use 'f4' to compute
+        in single precision, halving memory usage.
+    *cache_size*: int
+        Maximum size in bytes of an in-memory cache of interpolated inputs
+        and positive degree days, keyed by input content and the relevant
+        parameters, so that repeated calls with partly identical inputs only
+        recompute what changed. Least recently used entries are discarded
+        first. Zero (default) disables the cache.
+    *integration*: [ 'sampled' | 'analytic' ]
+        Method used to integrate positive degree days and accumulation
+        through the year. If 'sampled', sum values at `interpolate_n` points
+        of the interpolated time series. If 'analytic', only available with
+        the 'linear' interpolation rule, integrate exactly over each linear
+        segment between consecutive input time steps, so that the model runs
+        at the input time resolution. Instantaneous outputs are then averages
+        over segments centred on the boundaries of input time steps, and the
+        `interpolate_n` parameter is ignored.
+    *backend*: [ 'numpy' | 'numba' ]
+        Engine used when only cumulative outputs are requested. If 'numba',
+        run a compiled kernel looping in parallel over grid cells, fusing
+        interpolation, accumulation, positive degree days, snow depth,
+        refreezing and yearly sums without any time-dependent temporary
+        array. The kernel is used with sampled integration and scalar
+        parameters only, and always evaluates the Calov and Greve (2005)
+        integral exactly. Otherwise, or if Numba is not installed (with a
+        warning), the NumPy implementation is used.
+    *spinup*: [ None | 'periodic' ]
+        If 'periodic', replace the initial snow depth by the periodic steady
+        state, for which snow depth at the end of the year equals that at
+        the beginning. It is computed directly from the yearly snow balance
+        and its lowest running value, then checked, and iterated only where
+        the residual exceeds `spinup_tolerance`. Where the snow balance is
+        positive, snow accumulates every year and no steady state exists; the
+        smallest initial snow depth that never melts out is used instead.
+    *spinup_tolerance*: float
+        Maximum difference between initial and final snow depth for the
+        periodic spin-up to be considered converged.
+    *spinup_iterations*: int
+        Maximum number of spin-up iterations on unconverged cells.
+    *scratch_dir*: str
+        If set, output arrays assembled from tiles, worker processes or
+        active cells are allocated as memory-mapped temporary files in this
+        directory, deleted once arrays are released. Combined with
+        `tile_size`, this bounds resident memory by the tile size even if
+        all time-dependent outputs are requested.
+
+    Instrumentation hooks can be appended to the public `hooks` attribute.
+    Each hook is called after each named stage of the model, such as
+    'interpolate', 'inst_pdd', 'accu_rate', 'snow_depth', 'integrate',
+    'read' or 'write', with the stage name, wall time in seconds, and total
+    size in bytes and shapes of the arrays produced (or consumed, if none).
+    Array sizes are not memory allocated by the stage, and are zero for
+    time spent waiting between pipeline threads. If only cumulative outputs
+    are requested, stages are reported at each time step, except with the
+    compiled backend, reported as a single 'kernel' stage. A `Profiler`
+    instance can be used to collect and summarize these records. Stages
+    computed in worker processes, or while probing output shapes before
+    starting them, are not reported.
     """
 
     def __init__(self,
@@ -154,7 +647,19 @@ class PDDModel():
                  temp_snow=PARAMETERS['temp_snow'],
                  temp_rain=PARAMETERS['temp_rain'],
                  interpolate_rule=PARAMETERS['interpolate_rule'],
-                 interpolate_n=PARAMETERS['interpolate_n']):
+                 interpolate_n=PARAMETERS['interpolate_n'],
+                 solver=PARAMETERS['solver'],
+                 tile_size=PARAMETERS['tile_size'],
+                 inst_pdd_method=PARAMETERS['inst_pdd_method'],
+                 inst_pdd_tolerance=PARAMETERS['inst_pdd_tolerance'],
+                 dtype=PARAMETERS['dtype'],
+                 cache_size=PARAMETERS['cache_size'],
+                 integration=PARAMETERS['integration'],
+                 backend=PARAMETERS['backend'],
+                 spinup=PARAMETERS['spinup'],
+                 spinup_tolerance=PARAMETERS['spinup_tolerance'],
+                 spinup_iterations=PARAMETERS['spinup_iterations'],
+                 scratch_dir=PARAMETERS['scratch_dir']):
 
         # set pdd model parameters
         self.pdd_factor_snow = pdd_factor_snow
@@ -165,8 +670,46 @@ class PDDModel():
         self.temp_rain = temp_rain
         self.interpolate_rule = interpolate_rule
         self.interpolate_n = interpolate_n
-
-    def __call__(self, temp, prec, stdv=0.0):
+        self.solver = solver
+        self.tile_size = tile_size
+        self.inst_pdd_method = inst_pdd_method
+        self.inst_pdd_tolerance = inst_pdd_tolerance
+        self.dtype = dtype
+        self.cache_size = cache_size
+        self.integration = integration
+        self.backend = backend
+        self.spinup = spinup
+        self.spinup_tolerance = spinup_tolerance
+        self.spinup_iterations = spinup_iterations
+        self.scratch_dir = scratch_dir
+
+        # cache of interpolation operators and effective temperature tables
+        self._operators = collections.OrderedDict()
+        self._tables = {}
+
+        # cache of intermediate results and statistics
+        self._cache = collections.OrderedDict()
+        self._cache_stats = {'hits': 0, 'misses': 0}
+        self._spinup_stats = dict.fromkeys(
+            ('cells', 'accumulating', 'iterated', 'iterations', 'unconverged'),
+            0)
+
+        # instrumentation hooks
+        self.hooks = []
+
+        # pool of worker processes shared between runs, if any
+        self._pool = None
+
+    def __getstate__(self):
+        """Return picklable state without cache, hooks and worker pool."""
+        state = self.__dict__.copy()
+        state['_cache'] = collections.OrderedDict()
+        state['hooks'] = []
+        state['_pool'] = None
+        return state
+
+    def __call__(self, temp, prec, stdv=0.0, workers=None, outputs=None,
+                 initial_snow=0.0, mask=None):
         """Run the positive degree day model.
 
         Use temperature, precipitation, and standard deviation of temperature
@@ -179,6 +722,23 @@ class PDDModel():
             Input precipitation rate in meter per year.
         *stdv*: array_like (default 0.0)
             Input standard deviation of near-surface air temperature in Kelvin.
+        *workers*: int (default None)
+            Number of worker processes. If larger than one, split the grid in
+            spatial blocks (tiles of `tile_size` if set) computed in parallel,
+            with inputs and outputs exchanged through shared memory.
+        *outputs*: list of str (default None)
+            Names of output variables to compute. If only cumulative variables
+            are requested, yearly sums are accumulated step by step without
+            storing any time-dependent field. By default, compute all output
+            variables.
+        *initial_snow*: array_like (default 0.0)
+            Snow depth at the beginning of the year, constant in time.
+        *mask*: array_like of bool (default None)
+            Active cells, constant in time. Cells masked in any of the input
+            masked arrays, at any time, are considered inactive too. If a
+            mask is given or any input is a masked array, results are
+            returned as masked arrays, and if some cells are inactive, the
+            model is only run on active cells, gathered in a compact array.
 
         By default, inputs are N-dimensional arrays whose first dimension is
         interpreted as time and as periodic. Arrays of dimensions
@@ -188,96 +748,936 @@ class PDDModel():
         the number of dimensions N.
 
         Return the number of positive degree days ('pdd'), surface mass balance
-        ('smb'), and many other output variables in a dictionary.
+        ('smb'), and many other output variables in a dictionary-like
+        `PDDResults` mapping. Unless run by tiles or in parallel, variables
+        other than interpolated inputs, accumulation, melt rates and snow depth
+        are only computed when first accessed.
         """
 
+        # find active cells from mask argument and masked inputs
+        ndim = max(np.ndim(temp), np.ndim(prec), np.ndim(stdv))
+        active = None if mask is None else np.asarray(mask, dtype=bool)
+        for array in (temp, prec, stdv):
+            invalid = np.ma.getmask(array)
+            if invalid is not np.ma.nomask and invalid.ndim > 0:
+                if invalid.ndim == ndim:
+                    invalid = invalid.any(axis=0)
+                active = ~invalid if active is None else active & ~invalid
+
+        # if a mask applies, run the model on active cells only
+        if active is not None:
+            return self._run_active((temp, prec, stdv, initial_snow), active,
+                                    workers=workers, outputs=outputs)
+
         # ensure numpy arrays
-        temp = np.asarray(temp)
-        prec = np.asarray(prec)
-        stdv = np.asarray(stdv)
+        temp = np.asarray(temp, dtype=self.dtype)
+        prec = np.asarray(prec, dtype=self.dtype)
+        stdv = np.asarray(stdv, dtype=self.dtype)
+        snow = np.asarray(initial_snow, dtype=self.dtype)
+        inputs = (temp, prec, stdv, snow)
+
+        # find the largest shape
+        maxshape = np.broadcast_shapes(temp.shape, prec.shape, stdv.shape)
+
+        # check requested output variables
+        for varname in outputs or ():
+            if varname not in ATTRIBUTES or varname in ('x', 'y', 'time',
+                                                        'time_bounds'):
+                raise KeyError("%s is not a valid variable name" % varname)
+
+        # run the model in parallel if several workers are requested, unless
+        # there are no spatial dimensions to split or no cells
+        empty = 0 in maxshape[1:]
+        if workers is not None and workers > 1 and maxshape[1:] and not empty:
+            return PDDResults(self._run_parallel(inputs, maxshape, workers,
+                                                 outputs=outputs))
+
+        # run the model at once if tiling is off or there are no cells
+        if self.tile_size is None or empty:
+            return self._run(*inputs, maxshape, outputs=outputs)
+
+        # otherwise run the model tile by tile
+        tiles = self._tiles(maxshape[1:], self.tile_size)
+        return PDDResults(self._run_tiles(inputs, maxshape, tiles, {},
+                                          outputs=outputs))
+
+    def run_transient(self, forcing, initial_snow=0.0, workers=None,
+                      outputs=None, mask=None):
+        """Run the positive degree day model through consecutive years.
+
+        Iterate over yearly forcing, run the model for each year, and carry
+        the snow depth at the end of each year over to the next one. Only one
+        year of forcing and results is held in memory at any time.
+
+        *forcing*: iterable
+            Yearly (temp, prec) or (temp, prec, stdv) tuples of arrays, each
+            interpreted as by `__call__`, e.g. a generator reading from disk.
+        *initial_snow*: array_like (default 0.0)
+            Snow depth at the beginning of the first year.
+        *workers*: int (default None)
+            Number of worker processes passed to `__call__`.
+        *outputs*: list of str (default None)
+            Names of output variables to compute. By default, compute all
+            output variables.
+        *mask*: array_like of bool (default None)
+            Active cells, passed to `__call__`.
+
+        If the `spinup` attribute is set, the initial snow depth of the first
+        year only is replaced by its periodic steady state.
+
+        Yield a dictionary of output variables for each year.
+        """
+        model = self
+        snow = initial_snow
+        for year in forcing:
+            if outputs is None or 'final_snow_depth' in outputs:
+                results = model(*year, workers=workers, outputs=outputs,
+                                initial_snow=snow, mask=mask)
+                snow = results['final_snow_depth']
+            else:
+                results = model(*year, workers=workers, initial_snow=snow,
+                                outputs=list(outputs)+['final_snow_depth'],
+                                mask=mask)
+                snow = results.pop('final_snow_depth')
+            if model.spinup is not None:
+                model = copy.copy(self)
+                model.spinup = None
+            yield results
+
+    def _run_active(self, inputs, active, **kwargs):
+        """Run the model on active cells only and scatter results."""
+
+        # if all cells are active, run the model on unmasked data
+        if active.all():
+            inputs = [np.ma.getdata(array) for array in inputs]
+            results = self(*inputs[:3], initial_snow=inputs[3], **kwargs)
+            for varname in list(results):
+                results[varname] = np.ma.masked_array(results[varname])
+            return results
+
+        # gather active cells along a single spatial dimension
+        ndim = max(np.ndim(array) for array in inputs[:3])
+        active = np.broadcast_to(active, max(
+            (np.shape(array)[-ndim+1:] for array in inputs[:3]), key=len))
+        compact = []
+        for array in inputs:
+            array = np.asarray(np.ma.getdata(array), dtype=self.dtype)
+            if array.ndim == ndim:
+                array = array[:, active]
+            elif array.ndim == ndim-1:
+                array = array[active]
+            compact.append(array)
+
+        # tile the compact arrays by the same number of cells if needed
+        model = self
+        if self.tile_size is not None:
+            model = copy.copy(self)
+            model.tile_size = int(np.prod(self.tile_size))
+        results = model(*compact[:3], initial_snow=compact[3], **kwargs)
+
+        # scatter results into masked arrays
+        for varname, array in results.items():
+            scattered = np.ma.array(
+                self._zeros(array.shape[:-1]+active.shape, array.dtype),
+                mask=True)
+            scattered[..., active] = array
+            results[varname] = scattered
+        return results
+
+    def _run_tiles(self, inputs, maxshape, tiles, results, outputs=None):
+        """Run the model tile by tile and write results into arrays."""
+        for tile in tiles:
+            tileshape = maxshape[:1] + tuple(
+                len(range(n)[sl]) for sl, n in zip(tile, maxshape[1:]))
+            inputs_tile = [self._slice(array, tile, maxshape)
+                           for array in inputs]
+            for varname, array in self._run(*inputs_tile, tileshape,
+                                            outputs=outputs).items():
+                if varname not in results:
+                    results[varname] = self._zeros(
+                        array.shape[:array.ndim-len(tile)] + maxshape[1:],
+                        array.dtype)
+                results[varname][(Ellipsis,)+tile] = array
+        return results
+
+    def _run_parallel(self, inputs, maxshape, workers, outputs=None):
+        """Run the model on spatial blocks using a pool of processes."""
+
+        # use tiles if set, otherwise split the first spatial dimension
+        if self.tile_size is None:
+            size = (-(-maxshape[1]//workers),) + maxshape[2:]
+        else:
+            size = self.tile_size
+        tiles = list(self._tiles(maxshape[1:], size))
+
+        # probe output names, shapes and types on a single grid cell, without
+        # reporting the probe to hooks
+        cell = tuple(slice(0, 1) for _ in maxshape[1:])
+        prober = copy.copy(self)
+        prober.hooks = []
+        probe = prober._run(*[self._slice(array, cell, maxshape)
+                            for array in inputs],
+                            maxshape[:1] + (1,)*len(cell), outputs=outputs)
+
+        # copy inputs and allocate outputs in shared memory
+        segments = []
+        arrays = {}
+        inspecs = []
+        outspecs = {}
+        try:
+            for i, array in enumerate(inputs):
+                if array.ndim == 0:
+                    inspecs.append(array)
+                    continue
+                shm, arrays[i] = _shared_array(array.shape, array.dtype)
+                arrays[i][:] = array
+                segments.append(shm)
+                inspecs.append((shm.name, array.shape, array.dtype.str))
+            for varname, array in probe.items():
+                shape = array.shape[:array.ndim-len(cell)] + maxshape[1:]
+                shm, arrays[varname] = _shared_array(shape, array.dtype)
+                segments.append(shm)
+                outspecs[varname] = (shm.name, shape, array.dtype.str)
+
+            # run the model on each block in a worker process, in the
+            # shared pool if one is open
+            pool = self._pool or ProcessPoolExecutor(workers)
+            try:
+                futures = [pool.submit(_run_shared, self, inspecs, outspecs,
+                                       maxshape, tile) for tile in tiles]
+                for future in futures:
+                    future.result()
+            finally:
+                if pool is not self._pool:
+                    pool.shutdown()
+
+            # copy results out of shared memory
+            results = {}
+            for varname, array in probe.items():
+                results[varname] = self._zeros(arrays[varname].shape,
+                                               array.dtype)
+                results[varname][...] = arrays[varname]
+
+        # release shared memory
+        finally:
+            del arrays
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+        return results
+
+    @contextlib.contextmanager
+    def _shared_pool(self, workers):
+        """Share one pool of worker processes between runs in a context."""
+        if workers is None or workers < 2 or self._pool is not None:
+            yield
+            return
+        with ProcessPoolExecutor(workers) as self._pool:
+            try:
+                yield
+            finally:
+                self._pool = None
+
+    def _run(self, temp, prec, stdv, snow, maxshape, outputs=None):
+        """Run the model on arrays expandable to a common shape."""
 
         # expand arrays to the largest shape
-        maxshape = max(temp.shape, prec.shape, stdv.shape)
         temp = self._expand(temp, maxshape)
         prec = self._expand(prec, maxshape)
         stdv = self._expand(stdv, maxshape)
+        snow = np.broadcast_to(snow, maxshape[1:])
+
+        # if only cumulative outputs are requested, accumulate step by step
+        if outputs is not None and set(outputs) <= set(CUMULATIVE):
+            kernel = self._kernel()
+            if kernel is None:
+                results = self._run_cumulative(temp, prec, stdv, snow)
+            else:
+                results = self._stage('kernel', self._run_kernel,
+                                      kernel, temp, prec, stdv, snow)
+            return PDDResults(results, names=outputs)
+
+        # integrate linear segments between input time steps if requested
+        if self.integration == 'analytic':
+            return self._run_analytic(temp, prec, stdv, snow, outputs=outputs)
+
+        # interpolate time-series, using cache if enabled
+        if self.cache_size:
+            keys = [_array_key(array) for array in (temp, prec, stdv)]
+            rule = (self.interpolate_rule, self.interpolate_n)
+            temp, prec, stdv = [
+                self._cached(('interpolate', key) + rule, self._stage,
+                             'interpolate', self._interpolate, array)
+                for key, array in zip(keys, (temp, prec, stdv))]
+            method = (self.inst_pdd_method, self.inst_pdd_tolerance)
+            inst_pdd = self._cached(
+                ('inst_pdd', keys[0], keys[2]) + rule + method,
+                self._stage, 'inst_pdd', self.inst_pdd, temp, stdv)
+
+        # otherwise compute everything
+        else:
+            temp = self._stage('interpolate', self._interpolate, temp)
+            prec = self._stage('interpolate', self._interpolate, prec)
+            stdv = self._stage('interpolate', self._interpolate, stdv)
+            inst_pdd = self._stage('inst_pdd', self.inst_pdd, temp, stdv)
+
+        # compute accumulation and melt
+        return self._run_melt(temp, prec, stdv, inst_pdd, snow,
+                              outputs=outputs)
+
+    def _run_analytic(self, temp, prec, stdv, snow, outputs=None):
+        """Run the model on linear segments between input time steps."""
+
+        # find segment start and mean values
+        temp0, tempm = self._segments(temp)
+        prec0, precm = self._segments(prec)
+        stdvm = self._segments(stdv)[1]
+
+        # integrate positive degree days and accumulation over segments
+        inst_pdd = self._stage('inst_pdd', self._segment_pdd,
+                               temp0, temp, stdvm)
+        accu_rate = self._stage('accu_rate', self._segment_accu,
+                                temp0, temp, prec0, prec)
+
+        # compute melt
+        return self._run_melt(tempm, precm, stdvm, inst_pdd, snow,
+                              outputs=outputs, accu_rate=accu_rate)
+
+    def _run_melt(self, temp, prec, stdv, inst_pdd, snow, outputs=None,
+                  accu_rate=None):
+        """Compute accumulation, melt and outputs from interpolated data."""
+
+        # compute accumulation unless integrated already
+        if accu_rate is None:
+            accu_rate = self._stage('accu_rate', self.accu_rate, temp, prec)
+
+        # find periodic steady-state snow depth if requested
+        if self.spinup is not None:
+            snow = self._stage('spinup', self.periodic_snow, accu_rate,
+                               inst_pdd)
 
-        # interpolate time-series
-        temp = self._interpolate(temp)
-        prec = self._interpolate(prec)
-        stdv = self._interpolate(stdv)
+        # compute snow depth and melt rates
+        snow_depth, snow_melt_rate, ice_melt_rate = self._stage(
+            'snow_depth', self.snow_depth, accu_rate, inst_pdd, snow)
 
-        # compute accumulation and pdd
-        accu_rate = self.accu_rate(temp, prec)
-        inst_pdd = self.inst_pdd(temp, stdv)
+        # other variables are computed on demand
+        integrate = functools.partial(self._stage, 'integrate',
+                                      self._integrate)
+        runoff_rate = functools.partial(_runoff_rate,
+                                        refreeze_snow=self.refreeze_snow,
+                                        refreeze_ice=self.refreeze_ice)
 
-        # initialize snow depth and melt rates
-        snow_depth = np.zeros_like(temp)
-        snow_melt_rate = np.zeros_like(temp)
-        ice_melt_rate = np.zeros_like(temp)
+        # output
+        fields = {'temp':           temp,
+                  'prec':           prec,
+                  'stdv':           stdv,
+                  'inst_pdd':       inst_pdd,
+                  'accu_rate':      accu_rate,
+                  'snow_melt_rate': snow_melt_rate,
+                  'ice_melt_rate':  ice_melt_rate,
+                  'snow_depth':     snow_depth}
+        recipes = {
+            'melt_rate':   (np.add, ('snow_melt_rate', 'ice_melt_rate')),
+            'runoff_rate': (runoff_rate, ('melt_rate', 'snow_melt_rate',
+                                          'ice_melt_rate')),
+            'inst_smb':    (np.subtract, ('accu_rate', 'runoff_rate')),
+            'pdd':         (integrate, ('inst_pdd',)),
+            'accu':        (integrate, ('accu_rate',)),
+            'snow_melt':   (integrate, ('snow_melt_rate',)),
+            'ice_melt':    (integrate, ('ice_melt_rate',)),
+            'melt':        (integrate, ('melt_rate',)),
+            'runoff':      (integrate, ('runoff_rate',)),
+            'smb':         (integrate, ('inst_smb',)),
+            'final_snow_depth': (_last, ('snow_depth',))}
+        if outputs is None:
+            outputs = INSTANTANEOUS + CUMULATIVE
+        return PDDResults(fields, recipes, names=outputs)
+
+    def ensemble(self, temp, prec, stdv=0.0, outputs=None, initial_snow=0.0,
+                 **parameters):
+        """Run an ensemble of model parameter combinations.
+
+        Interpolation and positive degree days do not depend on the degree-day
+        factors, refreezing fractions and snow and rain temperature thresholds.
+        These parameter-independent stages are computed once, and the
+        remaining stages are vectorized over a new ensemble dimension.
+
+        *temp*, *prec*, *stdv*, *outputs*, *initial_snow*:
+            Inputs and output selection, interpreted as by `__call__`.
+        *pdd_factor_snow*, *pdd_factor_ice*, *refreeze_snow*, *refreeze_ice*,
+        *temp_snow*, *temp_rain*: array_like
+            One-dimensional arrays of parameter values, one per ensemble
+            member. Arrays are broadcast against each other, and parameters
+            not given take the values of the model attributes.
+
+        Return output variables in a dictionary of arrays whose first
+        dimension corresponds to ensemble members.
+        """
 
-        # compute snow depth and melt rates
-        for i in range(len(temp)):
-            if i > 0:
-                snow_depth[i] = snow_depth[i-1]
-            snow_depth[i] += accu_rate[i]
-            snow_melt_rate[i], ice_melt_rate[i] = self.melt_rates(
-                snow_depth[i], inst_pdd[i])
-            snow_depth[i] -= snow_melt_rate[i]
-        melt_rate = snow_melt_rate + ice_melt_rate
-        runoff_rate = melt_rate - self.refreeze_snow * snow_melt_rate \
-                                - self.refreeze_ice * ice_melt_rate
-        inst_smb = accu_rate - runoff_rate
+        # ensure numpy arrays
+        temp = np.asarray(temp, dtype=self.dtype)
+        prec = np.asarray(prec, dtype=self.dtype)
+        stdv = np.asarray(stdv, dtype=self.dtype)
+        snow = np.asarray(initial_snow, dtype=self.dtype)
+        maxshape = np.broadcast_shapes(temp.shape, prec.shape, stdv.shape)
+
+        # prepare a model with parameters varying along a new dimension,
+        # inserted after time and broadcast against the spatial dimensions
+        member = copy.copy(self)
+        for param, values in parameters.items():
+            if param not in ('pdd_factor_snow', 'pdd_factor_ice',
+                             'refreeze_snow', 'refreeze_ice',
+                             'temp_snow', 'temp_rain'):
+                raise TypeError('ensemble got an unexpected parameter %s'
+                                % param)
+            values = np.asarray(values, dtype=self.dtype)
+            values = values.reshape((-1,) + (1,)*len(maxshape[1:]))
+            setattr(member, param, values)
+        size = np.broadcast_shapes((1,), *[
+            np.shape(getattr(member, param))[:1] for param in parameters])[0]
+
+        # compute parameter-independent stages once, and accumulation
+        # for all members if integrated over segments
+        temp = self._expand(temp, maxshape)
+        prec = self._expand(prec, maxshape)
+        stdv = self._expand(stdv, maxshape)
+        accu_rate = None
+        if self.integration == 'analytic':
+            temp0, tempm = self._segments(temp)
+            prec0, precm = self._segments(prec)
+            stdv = self._segments(stdv)[1]
+            inst_pdd = self._segment_pdd(temp0, temp, stdv)
+            accu_rate = member._segment_accu(temp0[:, None], temp[:, None],
+                                             prec0[:, None], prec[:, None])
+            temp, prec = tempm, precm
+        else:
+            temp = self._interpolate(temp)
+            prec = self._interpolate(prec)
+            stdv = self._interpolate(stdv)
+            inst_pdd = self.inst_pdd(temp, stdv)
+
+        # compute parameter-dependent stages for all members
+        results = member._run_melt(temp[:, None], prec[:, None],
+                                   stdv[:, None], inst_pdd[:, None], snow,
+                                   outputs=outputs, accu_rate=accu_rate)
+
+        # move ensemble dimension first
+        for varname, array in results.items():
+            if array.ndim > len(maxshape):
+                array = np.broadcast_to(array, (len(array), size)+maxshape[1:])
+                results[varname] = np.moveaxis(array, 1, 0)
+            else:
+                results[varname] = np.broadcast_to(array, (size,)+maxshape[1:])
+        return results
+
+    def calibrate(self, temp, prec, stdv, observed_smb,
+                  params=('pdd_factor_snow', 'pdd_factor_ice'), mask=None,
+                  regions=None, bounds=(0.1, 10.0), candidates=8, passes=4):
+        """Calibrate degree-day factors against observed mass balance.
+
+        Find, for each grid cell or region, a factor by which to multiply the
+        degree-day factors in *params* (preserving their ratio) so that the
+        modelled surface mass balance matches observations. Interpolation,
+        positive degree days and accumulation are computed once. Each pass
+        evaluates all cells or regions at a number of candidate factors at
+        once, and narrows the bracket where modelled minus observed mass
+        balance changes sign, assuming it decreases with the factor. The final
+        factor is interpolated linearly within the last bracket.
+
+        Surface mass balance is linear in `pdd_factor_ice` alone, and
+        piecewise linear when both factors are scaled together, so that few
+        passes are needed. If only `pdd_factor_ice` is calibrated, a single
+        pass with two candidates is exact.
+
+        *temp*, *prec*, *stdv*: array_like
+            Input climate, interpreted as by `__call__`.
+        *observed_smb*: array_like
+            Observed surface mass balance, constant in time. Cells where
+            observations are not finite are ignored.
+        *params*: list of str
+            Degree-day factors to calibrate, 'pdd_factor_snow' and/or
+            'pdd_factor_ice'.
+        *mask*: array_like of bool
+            Cells to calibrate. By default, use all cells.
+        *regions*: array_like of int
+            Region labels. If set, calibrate one factor per region, matching
+            the mean modelled and observed mass balance over each region.
+        *bounds*: tuple of float
+            Range of multiplicative factors searched.
+        *candidates*: int
+            Number of candidate factors evaluated per pass.
+        *passes*: int
+            Number of bracket-narrowing passes.
+
+        Return calibrated parameter values in a dictionary. Values are arrays
+        of spatial shape, with NaN outside the calibrated cells, or, if
+        *regions* is given, one value per region label, with labels stored
+        under 'regions'. Values are NaN too for cells or regions whose mass
+        balance does not depend on the factor within *bounds*, e.g. without
+        ice melt if only `pdd_factor_ice` is calibrated.
+        """
 
-        # output
-        return {'temp':           temp,
-                'prec':           prec,
-                'stdv':           stdv,
-                'inst_pdd':       inst_pdd,
-                'accu_rate':      accu_rate,
-                'snow_melt_rate': snow_melt_rate,
-                'ice_melt_rate':  ice_melt_rate,
-                'melt_rate':      melt_rate,
-                'runoff_rate':    runoff_rate,
-                'inst_smb':       inst_smb,
-                'snow_depth':     snow_depth,
-                'pdd':            self._integrate(inst_pdd),
-                'accu':           self._integrate(accu_rate),
-                'snow_melt':      self._integrate(snow_melt_rate),
-                'ice_melt':       self._integrate(ice_melt_rate),
-                'melt':           self._integrate(melt_rate),
-                'runoff':         self._integrate(runoff_rate),
-                'smb':            self._integrate(inst_smb)}
+        # check parameters, use a single exact pass if possible
+        for param in params:
+            if param not in ('pdd_factor_snow', 'pdd_factor_ice'):
+                raise ValueError('can not calibrate parameter %s' % param)
+        if list(params) == ['pdd_factor_ice']:
+            candidates, passes = 2, 1
+
+        # ensure numpy arrays
+        temp = np.asarray(temp, dtype=self.dtype)
+        prec = np.asarray(prec, dtype=self.dtype)
+        stdv = np.asarray(stdv, dtype=self.dtype)
+        maxshape = np.broadcast_shapes(temp.shape, prec.shape, stdv.shape)
+
+        # select valid cells
+        observed = np.broadcast_to(
+            np.asarray(observed_smb, dtype=self.dtype), maxshape[1:])
+        valid = np.isfinite(observed)
+        if mask is not None:
+            valid &= np.broadcast_to(np.asarray(mask, dtype=bool),
+                                     maxshape[1:])
+        observed = observed[valid]
+
+        # compute forcing-dependent stages once on valid cells only
+        temp = self._expand(temp, maxshape)[:, valid]
+        prec = self._expand(prec, maxshape)[:, valid]
+        stdv = self._expand(stdv, maxshape)[:, valid]
+        if self.integration == 'analytic':
+            temp0, tempm = self._segments(temp)
+            prec0, precm = self._segments(prec)
+            stdv = self._segments(stdv)[1]
+            inst_pdd = self._segment_pdd(temp0, temp, stdv)
+            accu_rate = self._segment_accu(temp0, temp, prec0, prec)
+            temp, prec = tempm, precm
+        else:
+            temp = self._interpolate(temp)
+            prec = self._interpolate(prec)
+            stdv = self._interpolate(stdv)
+            inst_pdd = self.inst_pdd(temp, stdv)
+            accu_rate = self.accu_rate(temp, prec)
+
+        # map cells to calibration targets
+        labels = None
+        if regions is None:
+            inverse = np.arange(len(observed))
+            counts = np.ones_like(observed)
+        else:
+            labels, inverse = np.unique(
+                np.broadcast_to(regions, maxshape[1:])[valid],
+                return_inverse=True)
+            counts = np.bincount(inverse)
+            observed = np.bincount(inverse, observed) / counts
+        ntargets = len(observed)
+
+        def residual(factors):
+            """Modelled minus observed mass balance for candidate factors"""
+            member = copy.copy(self)
+            for param in params:
+                value = getattr(self, param) * factors[:, inverse]
+                setattr(member, param, value)
+            smb = member._run_melt(temp[:, None], prec[:, None],
+                                   stdv[:, None], inst_pdd[:, None], 0.0,
+                                   outputs=['smb'],
+                                   accu_rate=accu_rate[:, None])['smb']
+            if regions is not None:
+                smb = np.array([np.bincount(inverse, row, ntargets)
+                                for row in smb]) / counts
+            return smb - observed
+
+        # narrow brackets around the root in a few vectorized passes, noting
+        # targets whose mass balance does not depend on the factor
+        lower = np.full(ntargets, bounds[0])
+        upper = np.full(ntargets, bounds[1])
+        targets = np.arange(ntargets)
+        insensitive = np.zeros(ntargets, dtype=bool)
+        for i in range(passes):
+            factors = lower + (upper-lower)*np.linspace(
+                0, 1, candidates)[:, None]
+            errors = residual(factors)
+            if i == 0:
+                insensitive = np.ptp(errors, axis=0) == 0
+            crossed = errors <= 0
+            index = np.where(crossed.any(axis=0), crossed.argmax(axis=0),
+                             candidates-1).clip(1, candidates-1)
+            lower, upper = factors[index-1, targets], factors[index, targets]
+            errlow, errup = errors[index-1, targets], errors[index, targets]
+
+        # interpolate linearly within the last bracket
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = lower + (upper-lower)*errlow/(errlow-errup)
+        factor = np.where(errlow == errup, lower, factor).clip(lower, upper)
+        factor[insensitive] = np.nan
+
+        # return calibrated parameters
+        results = {}
+        for param in params:
+            values = getattr(self, param)*factor
+            if regions is None:
+                results[param] = np.full(maxshape[1:], np.nan, self.dtype)
+                results[param][valid] = values
+            else:
+                results[param] = values
+        if labels is not None:
+            results['regions'] = labels
+        return results
+
+    def _run_cumulative(self, temp, prec, stdv, snow):
+        """Accumulate yearly sums without storing time-dependent fields."""
+
+        # prepare interpolants or segments and cumulative sums
+        analytic = self.integration == 'analytic'
+        if analytic:
+            self._segments(temp[:1])
+            npts = len(temp)
+        else:
+            npts = self.interpolate_n
+            weights = self._operator(len(temp)).astype(temp.dtype, copy=False)
+        sums = dict.fromkeys(CUMULATIVE[:-1], 0.0)
+
+        def step(i):
+            """Return accumulation and positive degree days at step i"""
+            if analytic:
+                accu_rate = self._stage('accu_rate', self._segment_accu,
+                                        temp[i-1], temp[i], prec[i-1], prec[i])
+                inst_pdd = self._stage('inst_pdd', self._segment_pdd,
+                                       temp[i-1], temp[i],
+                                       (stdv[i-1]+stdv[i])/2)
+            else:
+                temp_i, prec_i, stdv_i = [
+                    array[0] if array.strides[0] == 0 else
+                    self._stage('interpolate', _weighted_sum,
+                                weights[i:i+1], array)[0]
+                    for array in (temp, prec, stdv)]
+                accu_rate = self._stage('accu_rate', self.accu_rate,
+                                        temp_i, prec_i)
+                inst_pdd = self._stage('inst_pdd', self.inst_pdd,
+                                       temp_i, stdv_i)
+            return accu_rate, inst_pdd
+
+        def melt(accu_rate, inst_pdd):
+            """Update snow depth in place and return melt rates"""
+            snow_depth[...] += accu_rate
+            snow_melt_rate, ice_melt_rate = self.melt_rates(
+                snow_depth, inst_pdd)
+            snow_depth[...] -= snow_melt_rate
+            return snow_melt_rate, ice_melt_rate
+
+        def integrate(accu_rate, inst_pdd, snow_melt_rate, ice_melt_rate):
+            """Add rates at one step to cumulative sums"""
+            melt_rate = snow_melt_rate + ice_melt_rate
+            runoff_rate = melt_rate - self.refreeze_snow * snow_melt_rate \
+                                    - self.refreeze_ice * ice_melt_rate
+            sums['pdd'] += inst_pdd
+            sums['accu'] += accu_rate
+            sums['snow_melt'] += snow_melt_rate
+            sums['ice_melt'] += ice_melt_rate
+            sums['melt'] += melt_rate
+            sums['runoff'] += runoff_rate
+            sums['smb'] += accu_rate - runoff_rate
+
+        # find periodic snow depth from a first pass if requested
+        if self.spinup is not None:
+            balance = lowest = 0.0
+            for i in range(npts):
+                accu_rate, inst_pdd = step(i)
+                balance = balance + accu_rate - self.pdd_factor_snow*inst_pdd
+                lowest = np.minimum(lowest, balance)
+            snow = self._periodic_start(balance, lowest)
+            self._spinup_stats['cells'] += np.size(snow)
+            self._spinup_stats['accumulating'] += int(np.sum(balance > 0))
+        snow_depth = np.array(snow, dtype=temp.dtype)
+
+        # step through time, updating snow depth and cumulative sums
+        for i in range(npts):
+            accu_rate, inst_pdd = step(i)
+            rates = self._stage('snow_depth', melt, accu_rate, inst_pdd)
+            self._stage('integrate', integrate, accu_rate, inst_pdd, *rates)
+
+        # return yearly integrals and final snow depth
+        steps = npts if analytic else npts-1
+        results = {varname: total/steps for varname, total in sums.items()}
+        results['final_snow_depth'] = snow_depth
+        return results
+
+    def _kernel(self):
+        """Return a compiled cumulative kernel if enabled and usable."""
+
+        # use numpy unless numba is requested and parameters are scalar
+        if self.backend == 'numpy':
+            return None
+        if self.backend != 'numba':
+            raise ValueError('unknown backend %s' % self.backend)
+        if self.integration != 'sampled' or self.spinup is not None or any(
+                np.ndim(getattr(self, param)) for param in _KERNEL_PARAMS):
+            return None
+
+        # fall back to numpy if numba is not installed
+        try:
+            return _numba_kernel()
+        except ImportError:
+            warnings.warn('Numba not found, using numpy backend.')
+            return None
+
+    def _run_kernel(self, kernel, temp, prec, stdv, snow):
+        """Accumulate yearly sums over grid cells in a compiled kernel."""
+
+        def columns(array):
+            """Flatten spatial dimensions, keeping broadcast ones short"""
+            array = _compact(array)
+            if array.size // len(array) not in (1, ncells):
+                array = np.broadcast_to(array, array.shape[:1]+spatial)
+            return np.ascontiguousarray(array).reshape(len(array), -1)
+
+        # prepare flat inputs, operator in compressed rows of non-zero
+        # weights, parameters and outputs
+        spatial = temp.shape[1:]
+        ncells = int(np.prod(spatial))
+        inputs = [columns(array) for array in (temp, prec, stdv, snow[None])]
+        operator = self._operator(len(temp))
+        rows, indices = np.nonzero(operator)
+        weights = (np.searchsorted(rows, np.arange(len(operator)+1)),
+                   indices, operator[rows, indices])
+        params = np.array([getattr(self, param) for param in _KERNEL_PARAMS],
+                          dtype='f8')
+        outputs = np.empty((8, ncells), dtype=temp.dtype)
+
+        # run kernel and return reshaped outputs
+        kernel(*inputs, weights, params, outputs)
+        return {varname: array.reshape(spatial)
+                for varname, array in zip(CUMULATIVE, outputs)}
+
+    def _cached(self, key, function, *args):
+        """Return a cached result, or compute and store it."""
+
+        # return result from cache if possible
+        if key in self._cache:
+            self._cache_stats['hits'] += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        # otherwise compute a read-only result
+        self._cache_stats['misses'] += 1
+        result = function(*args)
+        result.flags.writeable = False
+
+        # store it, discarding least recently used results beyond cache size
+        self._cache[key] = result
+        while self.cache_info()['size'] > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _stage(self, name, function, *args):
+        """Call function as a named stage, reporting to hooks if any."""
+
+        # without hooks, just call the function
+        if not self.hooks:
+            return function(*args)
+
+        # otherwise measure wall time
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+
+        # describe arrays produced, or consumed if none, and call hooks
+        arrays = args if result is None else result
+        if isinstance(arrays, dict):
+            arrays = arrays.values()
+        elif not isinstance(arrays, (tuple, list)):
+            arrays = [arrays]
+        arrays = [array for array in arrays if isinstance(array, np.ndarray)]
+        array_bytes = sum(_compact(array).nbytes for array in arrays)
+        shapes = [array.shape for array in arrays]
+        for hook in self.hooks:
+            hook(name, seconds, array_bytes, shapes)
+        return result
+
+    def cache_info(self):
+        """Return cache hits, misses, number of entries and size in bytes."""
+        return dict(self._cache_stats, entries=len(self._cache),
+                    size=sum(_compact(array).nbytes
+                             for array in self._cache.values()))
+
+    def spinup_info(self):
+        """Return periodic spin-up statistics since model creation.
+
+        Statistics include the number of cells spun up, cells where snow
+        accumulates every year, cells iterated after the direct solution,
+        the largest number of iterations and cells left unconverged.
+        """
+        return dict(self._spinup_stats)
+
+    def cache_clear(self):
+        """Clear the cache and its statistics."""
+        self._cache.clear()
+        self._cache_stats.update(hits=0, misses=0)
+
+    def _zeros(self, shape, dtype):
+        """Allocate an output array, on disk if a scratch directory is set"""
+        if self.scratch_dir is None or not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.scratch_dir),
+                         dtype=dtype, mode='w+', shape=shape)
 
     def _expand(self, array, shape):
-        """Expand an array to the given shape"""
-        if array.shape == shape:
-            res = array
-        elif array.shape == (1, shape[1], shape[2]):
-            res = np.asarray([array[0]]*shape[0])
-        elif array.shape == shape[1:]:
-            res = np.asarray([array]*shape[0])
-        elif array.shape == ():
-            res = array * np.ones(shape)
+        """Expand an array to the given shape as a read-only view"""
+        if array.shape in (shape, (1,)+shape[1:], shape[1:], ()):
+            res = np.broadcast_to(array, shape)
         else:
             raise ValueError('could not expand array of shape %s to %s'
                              % (array.shape, shape))
         return res
 
+    def _slice(self, array, tile, shape):
+        """Slice an array expandable to shape along spatial dimensions"""
+        if array.ndim == len(shape):
+            res = array[(slice(None),)+tile]
+        elif array.ndim == len(shape)-1:
+            res = array[tile]
+        else:
+            res = array
+        return res
+
+    def _tiles(self, shape, size):
+        """Iterate over spatial tiles of given size covering shape"""
+        size = np.broadcast_to(size, (len(shape),))
+        starts = [range(0, n, s) for n, s in zip(shape, size)]
+        for corner in itertools.product(*starts):
+            yield tuple(slice(i, i+s) for i, s in zip(corner, size))
+
     def _integrate(self, array):
         """Integrate an array over one year"""
+        if self.integration == 'analytic':
+            return np.mean(array, axis=0)
         return np.sum(array, axis=0)/(self.interpolate_n-1)
 
+    def _segments(self, array):
+        """Return start and mean values of periodic linear segments"""
+        if self.interpolate_rule != 'linear':
+            raise ValueError('analytic integration requires linear '
+                             'interpolation, not %s' % self.interpolate_rule)
+        if array.strides[0] == 0:
+            return array, array
+        start = np.roll(array, 1, axis=0)
+        return start, (start+array)/2
+
+    def _segment_pdd(self, temp0, temp1, stdv):
+        """Average positive degree days over linear temperature segments.
+
+        With temperature varying linearly from *temp0* to *temp1* and
+        constant standard deviation *stdv*, the average effective temperature
+        is (F(temp1)-F(temp0))/(temp1-temp0), where F is the antiderivative
+        of the Calov and Greve (2005) integrand with respect to temperature,
+        or half the squared positive part of temperature if *stdv* is zero.
+        Where both ends are too close for this difference to be accurate, the
+        effective temperature at the segment midpoint is used instead.
+        """
+        import scipy.special as sp
+
+        # compute in double precision to limit cancellation errors
+        dtype = np.result_type(temp0, temp1, stdv)
+        temp0, temp1, stdv = np.broadcast_arrays(
+            *[np.asarray(array, dtype='f8') for array in (temp0, temp1, stdv)])
+
+        def antiderivative(temp):
+            """Antiderivative of effective temperature"""
+            with np.errstate(divide='ignore', invalid='ignore'):
+                normtemp = temp/stdv
+                cdf = sp.ndtr(normtemp)
+                pdf = np.exp(-normtemp**2/2)/(2*np.pi)**0.5
+                prim = ((temp**2+stdv**2)*cdf + temp*stdv*pdf)/2
+            return np.where(stdv > 0, prim, np.maximum(temp, 0)**2/2)
+
+        # integrate over segments, or use midpoint value for short segments
+        delta = temp1 - temp0
+        short = np.abs(delta) <= np.finfo('f8').eps**0.5 * (
+            1 + np.abs(temp0) + np.abs(temp1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            teff = (antiderivative(temp1)-antiderivative(temp0))/delta
+        if short.any():
+            teff[short] = self.inst_pdd(((temp0+temp1)/2)[short],
+                                        stdv[short])/365.242198781
+
+        # convert to degree-days
+        return (teff*365.242198781).astype(dtype, copy=False)
+
+    def _segment_accu(self, temp0, temp1, prec0, prec1):
+        """Average accumulation rate over linear segments.
+
+        With temperature and precipitation varying linearly along a segment,
+        the accumulation rate is quadratic between the points where
+        temperature crosses the `temp_snow` and `temp_rain` thresholds, so
+        that Simpson's rule is exact on each of the (up to three) pieces.
+        """
+
+        # find normalized threshold crossings within the segment
+        delta = temp1 - temp0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossings = [np.where(delta == 0, 0.0,
+                                  (threshold-temp0)/delta).clip(0, 1)
+                         for threshold in (self.temp_snow, self.temp_rain)]
+        bounds = [0.0, np.minimum(*crossings), np.maximum(*crossings), 1.0]
+
+        def accu_rate(fraction):
+            """Accumulation rate at a fraction of the segment"""
+            return self.accu_rate(temp0 + delta*fraction,
+                                  prec0 + (prec1-prec0)*fraction)
+
+        # apply Simpson's rule on each piece
+        accu = 0.0
+        for lower, upper in zip(bounds[:-1], bounds[1:]):
+            accu = accu + (upper-lower)/6 * (
+                accu_rate(lower) + 4*accu_rate((lower+upper)/2) +
+                accu_rate(upper))
+        return accu
+
     def _interpolate(self, array):
         """Interpolate an array through one year."""
-        from scipy.interpolate import interp1d
-        rule = self.interpolate_rule
+
+        # time-constant arrays need no interpolation
+        if array.strides[0] == 0:
+            shape = (self.interpolate_n,) + array.shape[1:]
+            return np.broadcast_to(array[0], shape)
+
+        # otherwise apply interpolation operator, summing its non-zero
+        # weights in a fixed order so that results do not depend on shape
+        operator = self._operator(len(array)).astype(array.dtype, copy=False)
+        return _weighted_sum(operator, array)
+
+    def _operator(self, length):
+        """Return a cached periodic interpolation operator.
+
+        Interpolation being linear in the data, interpolating a time series of
+        given length through one year amounts to a matrix product. The matrix
+        of shape (interpolate_n, length) includes the periodic wrap, and is
+        computed once for each combination of length, interpolation rule and
+        number of points. The last few matrices are kept in a small cache.
+        """
+
+        # return operator from cache if possible
+        key = (length, self.interpolate_rule, self.interpolate_n)
+        if key in self._operators:
+            self._operators.move_to_end(key)
+            return self._operators[key]
+
+        # interpolate identity matrix with periodic wrap
         npts = self.interpolate_n
-        oldx = (np.arange(len(array)+2)-0.5) / len(array)
-        oldy = np.vstack(([array[-1]], array, [array[0]]))
+        oldx = (np.arange(length+2)-0.5) / length
+        oldy = np.eye(length)[np.arange(-1, length+1) % length]
         newx = (np.arange(npts)+0.5) / npts  # use 0.0 for PISM-like behaviour
-        newy = interp1d(oldx, oldy, kind=rule, axis=0)(newx)
-        return newy
+        if self.interpolate_rule == 'linear':
+            operator = np.array([np.interp(newx, oldx, col)
+                                 for col in oldy.T]).T
+        else:
+            from scipy.interpolate import interp1d
+            operator = interp1d(oldx, oldy, kind=self.interpolate_rule,
+                                axis=0)(newx)
+
+        # store operator in cache, discarding the least recently used
+        self._operators[key] = operator
+        if len(self._operators) > 8:
+            self._operators.popitem(last=False)
+        return operator
 
     def inst_pdd(self, temp, stdv):
         """Compute instantaneous positive degree days from temperature.
@@ -290,24 +1690,101 @@ class PDDModel():
             Near-surface air temperature in degrees Celcius.
         *stdv*: array_like
             Standard deviation of near-surface air temperature in Kelvin.
+
+        The Calov and Greve (2005) integral is only evaluated where the
+        standard deviation is positive, using the method set by the
+        `inst_pdd_method` attribute.
         """
-        import scipy.special as sp
 
         # compute positive part of temperature everywhere
-        positivepart = np.greater(temp, 0)*temp
-
-        # compute Calov and Greve (2005) integrand, ignoring division by zero
-        with np.errstate(divide='ignore', invalid='ignore'):
-            normtemp = temp / (np.sqrt(2)*stdv)
-        calovgreve = (stdv/np.sqrt(2*np.pi)*np.exp(-normtemp**2) +
-                      temp/2*sp.erfc(-normtemp))
-
-        # use positive part where sigma is zero and Calov and Greve elsewhere
-        teff = np.where(stdv == 0., positivepart, calovgreve)
+        temp, stdv = np.broadcast_arrays(temp, stdv)
+        teff = np.greater(temp, 0)*temp
+
+        # use Calov and Greve (2005) integrand where sigma is positive,
+        # evaluating the mask on non-broadcast data only
+        mask = _compact(stdv) > 0
+        if mask.all():
+            teff = self._calov_greve(temp, stdv)
+        elif mask.any():
+            mask = np.broadcast_to(mask, teff.shape)
+            teff[mask] = self._calov_greve(temp[mask], stdv[mask])
 
         # convert to degree-days
         return teff*365.242198781
 
+    def check_dtype(self, temp, prec, stdv=0.0):
+        """Compare results to a double precision reference.
+
+        Run the model in the precision set by the `dtype` attribute and in
+        double precision, and return the maximum absolute difference for each
+        output variable in a dictionary.
+        """
+        reference = copy.copy(self)
+        reference.dtype = 'f8'
+        results = self(temp, prec, stdv)
+        expected = reference(temp, prec, stdv)
+        return {varname: float(np.max(np.abs(results[varname] -
+                                             expected[varname])))
+                for varname in results}
+
+    def _calov_greve(self, temp, stdv):
+        """Compute Calov and Greve (2005) effective temperature."""
+
+        # evaluate exponential and error functions
+        if self.inst_pdd_method == 'exact':
+            import scipy.special as sp
+            normtemp = temp / (2**0.5*stdv)
+            teff = (stdv/(2*np.pi)**0.5*np.exp(-normtemp**2) +
+                    temp/2*sp.erfc(-normtemp))
+
+        # interpolate the excess over positive part in a table, using
+        # teff(temp) = max(temp, 0) + stdv*g(|temp|/stdv), where g decreases
+        # from 1/sqrt(2*pi) to zero and has a second derivative below that
+        elif self.inst_pdd_method == 'table':
+            step, table = self._calov_greve_table()
+            table = table.astype(temp.dtype, copy=False)
+            index = np.minimum(np.abs(temp)/stdv/step, len(table)-1)
+            lower = np.minimum(index.astype(int), len(table)-2)
+            weight = index - lower
+            teff = (np.greater(temp, 0)*temp + stdv*(
+                (1-weight)*table[lower] + weight*table[lower+1]))
+
+        # other methods are not implemented
+        else:
+            raise ValueError('unknown inst_pdd method %s'
+                             % self.inst_pdd_method)
+
+        # return effective temperature
+        return teff
+
+    def _calov_greve_table(self):
+        """Return a cached table of normalized effective temperature excess.
+
+        The excess g(z) = f(-z), where f is the normalized Calov and Greve
+        (2005) integrand, is tabulated on a regular grid of non-negative z.
+        Linear interpolation error is bounded by step**2/8 times the maximum
+        second derivative 1/sqrt(2*pi), and the table is cut where g falls
+        below tolerance, so that the total error is below tolerance.
+        """
+        import scipy.special as sp
+
+        # return table from cache if possible
+        tolerance = self.inst_pdd_tolerance
+        if tolerance in self._tables:
+            return self._tables[tolerance]
+
+        # compute step and table extent from tolerance
+        step = np.sqrt(8*tolerance*np.sqrt(2*np.pi))
+        normtemp = np.arange(0, 40, step)
+        table = (np.exp(-normtemp**2/2)/np.sqrt(2*np.pi) -
+                 normtemp/2*sp.erfc(normtemp/np.sqrt(2)))
+        table = table[:np.argmax(table < tolerance)+1]
+        table[-1] = 0.0
+
+        # store table in cache
+        self._tables[tolerance] = step, table
+        return step, table
+
     def accu_rate(self, temp, prec):
         """Compute accumulation rate from temperature and precipitation.
 
@@ -357,8 +1834,149 @@ class PDDModel():
         # return melt rates
         return (snow_melt, ice_melt)
 
+    def periodic_snow(self, accu_rate, inst_pdd):
+        """Compute periodic steady-state snow depth at the start of the year.
+
+        Snow depth at the end of the year is B + max(s, -m), where s is the
+        initial snow depth, B the yearly snow balance (accumulation minus
+        potential snow melt) and m the lowest value of its running sum. If B
+        is negative, the unique periodic solution is s = B - m. Otherwise,
+        snow accumulates from year to year, and s = max(-m, 0), the smallest
+        depth that never melts out, is returned. The solution is checked by
+        running the snow depth model once, and iterated where the residual
+        exceeds the `spinup_tolerance` attribute, for at most
+        `spinup_iterations` iterations.
+
+        *accu_rate*: array_like
+            Accumulation rate, with time as first dimension.
+        *inst_pdd*: array_like
+            Number of positive degree days, with time as first dimension.
+
+        Return initial snow depth.
+        """
+
+        # check spin-up method
+        if self.spinup != 'periodic':
+            raise ValueError('unknown spin-up method %s' % self.spinup)
+
+        # solve for periodic snow depth directly
+        balance = np.cumsum(accu_rate - self.pdd_factor_snow*inst_pdd, axis=0)
+        snow = self._periodic_start(balance[-1], balance.min(axis=0))
+        accumulating = balance[-1] > 0
+        shape = balance.shape
+        del balance
+
+        # check the residual and iterate on unconverged cells only, indexing
+        # time series as a single cell
+        cells = shape[1:] or (1,)
+        accu_rate = np.broadcast_to(accu_rate, shape).reshape(shape[:1]+cells)
+        inst_pdd = np.broadcast_to(inst_pdd, shape).reshape(shape[:1]+cells)
+        snow = np.array(np.broadcast_to(snow, cells))
+        active = np.array(~np.broadcast_to(accumulating, cells))
+        iterated = iterations = 0
+        for iterations in range(self.spinup_iterations+1):
+            model = copy.copy(self)
+            for param in ('pdd_factor_snow', 'pdd_factor_ice'):
+                values = getattr(self, param)
+                if np.ndim(values) > 0:
+                    setattr(model, param,
+                            np.broadcast_to(values, cells)[active])
+            final = model.snow_depth(accu_rate[:, active], inst_pdd[:, active],
+                                     snow[active])[0][-1]
+            converged = np.abs(final - snow[active]) <= self.spinup_tolerance
+            snow[active] = final
+            active[active] = ~converged
+            if not active.any():
+                break
+            iterated = max(iterated, active.sum())
+
+        # record statistics and return snow depth
+        stats = self._spinup_stats
+        stats['cells'] += snow.size
+        stats['accumulating'] += int(np.sum(accumulating))
+        stats['iterated'] += int(iterated)
+        stats['iterations'] = max(stats['iterations'], iterations)
+        stats['unconverged'] += int(active.sum())
+        return snow.reshape(shape[1:])
+
+    @staticmethod
+    def _periodic_start(balance, lowest):
+        """Periodic initial snow depth from yearly and lowest snow balance"""
+        return np.maximum(np.minimum(balance, 0) - lowest, 0)
+
+    def snow_depth(self, accu_rate, inst_pdd, initial=0.0):
+        """Compute snow depth and melt rates through time.
+
+        Snow depth evolves as the positive part of the previous snow depth
+        plus accumulation minus potential snow melt. This recursion is solved
+        according to the `solver` attribute, either explicitly in time or for
+        all time steps at once as the difference between the cumulative mass
+        balance of snow and its running minimum.
+
+        *accu_rate*: array_like
+            Accumulation rate, with time as first dimension.
+        *inst_pdd*: array_like
+            Number of positive degree days, with time as first dimension.
+        *initial*: array_like (default 0.0)
+            Snow depth before the first time step.
+
+        Return snow depth, snow melt rate and ice melt rate.
+        """
+
+        # potential snow melt, later turned into ice melt in place
+        initial = np.asarray(initial, dtype=accu_rate.dtype)
+        shape = np.broadcast_shapes(
+            accu_rate.shape, np.shape(inst_pdd),
+            np.shape(self.pdd_factor_snow), np.shape(self.pdd_factor_ice))
+        ice_melt_rate = np.empty(shape, dtype=accu_rate.dtype)
+        np.multiply(self.pdd_factor_snow, inst_pdd, out=ice_melt_rate)
+        snow_depth = np.empty_like(ice_melt_rate)
+        snow_melt_rate = np.empty_like(ice_melt_rate)
+
+        # solve snow depth explicitly in time, in preallocated rows
+        if self.solver == 'loop':
+            previous = initial
+            for i in range(len(accu_rate)):
+                np.add(previous, accu_rate[i], out=snow_depth[i])
+                np.minimum(snow_depth[i], ice_melt_rate[i],
+                           out=snow_melt_rate[i])
+                snow_depth[i] -= snow_melt_rate[i]
+                previous = snow_depth[i]
+
+        # solve snow depth using cumulative sum and running minimum, both
+        # accumulated row by row as this is faster than along a strided axis
+        elif self.solver == 'cumsum':
+            np.subtract(accu_rate, ice_melt_rate, out=snow_depth)
+            lowest = -initial
+            for i in range(len(accu_rate)):
+                if i > 0:
+                    snow_depth[i] += snow_depth[i-1]
+                lowest = np.minimum(lowest, snow_depth[i],
+                                    out=snow_melt_rate[i])
+            snow_depth -= snow_melt_rate
+
+            # snow melt is limited by snow before melt
+            snow_melt_rate[0] = initial
+            snow_melt_rate[1:] = snow_depth[:-1]
+            snow_melt_rate += accu_rate
+            np.minimum(snow_melt_rate, ice_melt_rate, out=snow_melt_rate)
+
+        # other solvers are not implemented
+        else:
+            raise ValueError('unknown snow depth solver %s' % self.solver)
+
+        # ice melt is proportional to excess snow melt
+        ice_melt_rate -= snow_melt_rate
+        ice_melt_rate *= self.pdd_factor_ice
+        ice_melt_rate /= self.pdd_factor_snow
+
+        # return snow depth and melt rates
+        return snow_depth, snow_melt_rate, ice_melt_rate
+
     def nco(self, input_file, output_file,
-            output_size='small', output_variables=None):
+            output_size='small', output_variables=None, workers=None,
+            steps_per_year=None, block_size=None, mask_variable=None,
+            queue_size=2):
         """NetCDF operator.
 
         Read near-surface air temperature, precipitation rate, and standard
@@ -384,46 +2002,136 @@ class PDDModel():
         *output_variables*: list of str
             List of output variables to write in the output file. Prevails
             over any choice of *output_size*.
+        *workers*: int
+            Number of worker processes used to run the model in parallel.
+        *steps_per_year*: int
+            If set, interpret the input time axis as consecutive years of
+            this many records each, and run a transient simulation reading,
+            computing and writing one year at a time, with snow depth carried
+            over from one year to the next. Cumulative output variables are
+            then written along an additional 'year' dimension. The length
+            of the input time axis must be a multiple of this number.
+        *block_size*: int or tuple of int
+            Size of spatial blocks read, computed and written one at a time,
+            so that only one block of input and output data is held in
+            memory. By default, use the model `tile_size` if set, so that
+            each tile is written to the output file as soon as computed, the
+            chunk size of the input temperature variable if it is chunked,
+            and the whole grid otherwise.
+        *mask_variable*: str
+            Name of a two-dimensional input variable flagging active cells
+            with non-zero values. The model is only run on active cells, and
+            on cells where input data are not missing, and output variables
+            are filled with missing values elsewhere.
+        *queue_size*: int
+            Number of blocks (or block-years if transient) that can wait
+            between a reader thread, the model, and a writer thread, so that
+            reading the next block and writing the previous one overlap with
+            computation. Calls to the netCDF library are serialized. Time
+            spent by each thread waiting on the others is reported to hooks
+            as stages 'wait_read', 'wait_compute' and 'wait_write'. If zero,
+            read, compute and write one block after another.
         """
         import netCDF4 as nc4
 
-        # open netcdf files
-        ids = nc4.Dataset(input_file, 'r')
-        ods = nc4.Dataset(output_file, 'w', format='NETCDF3_CLASSIC')
-
-        # read input temperature data
+        # open netcdf files, always closed, and output removed on failure
+        with nc4.Dataset(input_file, 'r') as ids:
+            ods = nc4.Dataset(output_file, 'w', format='NETCDF3_CLASSIC')
+            try:
+                self._nco(ids, ods, input_file, output_size=output_size,
+                          output_variables=output_variables, workers=workers,
+                          steps_per_year=steps_per_year, block_size=block_size,
+                          mask_variable=mask_variable, queue_size=queue_size)
+            except BaseException:
+                ods.close()
+                os.remove(output_file)
+                raise
+            ods.close()
+
+    def _nco(self, ids, ods, input_file, output_size='small',
+             output_variables=None, workers=None, steps_per_year=None,
+             block_size=None, mask_variable=None, queue_size=2):
+        """Run the netCDF operator on open input and output datasets."""
+
+        # get input temperature variable
         try:
-            temp = ids.variables['temp'][:]
+            tempvar = ids.variables['temp']
         except KeyError:
             raise KeyError('could not find input variable %s (%s) in file %s.'
                            % ('temp', ATTRIBUTES['temp']['long_name'], input_file))
 
-        # read input precipitation data
+        # get input precipitation variable
         try:
-            prec = ids.variables['prec'][:]
+            precvar = ids.variables['prec']
         except KeyError:
             raise KeyError('could not find input variable %s (%s) in file %s.'
                            % ('prec', ATTRIBUTES['prec']['long_name'], input_file))
 
-        # read input standard deviation, warn and use zero if absent
+        # get input standard deviation variable, warn and use zero if absent
         try:
-            stdv = ids.variables['stdv'][:]
+            stdvvar = ids.variables['stdv']
         except KeyError:
-            import warnings
             warnings.warn('Variable stdv not found, assuming zero everywhere.')
-            stdv = 0.0
+            stdvvar = None
 
-        # convert to degC
-        # TODO: handle unit conversion better
-        if ids.variables['temp'].units in ('K', 'Kelvin'):
-            temp = temp - 273.15
+        # get input mask variable if requested
+        if mask_variable is None:
+            maskvar = None
+        else:
+            try:
+                maskvar = ids.variables[mask_variable]
+            except KeyError:
+                raise KeyError('could not find input mask variable %s in '
+                               'file %s.' % (mask_variable, input_file))
 
         # get dimensions tuple from temp variable
-        txydim = ids.variables['temp'].dimensions
+        txydim = tempvar.dimensions
         xydim = txydim[1:]
 
+        # split the input time axis in years
+        ntime = len(ids.dimensions[txydim[0]])
+        transient = steps_per_year is not None
+        if not transient:
+            steps_per_year = ntime
+        if ntime % steps_per_year:
+            raise ValueError('time length %d of file %s is not a multiple of '
+                             '%d steps per year.'
+                             % (ntime, input_file, steps_per_year))
+        nyears = ntime // steps_per_year
+
+        # split the spatial domain in blocks, matching input chunks
+        xyshape = tempvar.shape[1:]
+        if block_size is None:
+            chunking = tempvar.chunking()
+            if self.tile_size is not None:
+                block_size = self.tile_size
+            elif chunking in (None, 'contiguous'):
+                block_size = xyshape
+            else:
+                block_size = chunking[1:]
+        blocks = list(self._tiles(xyshape, block_size))
+
+        # the netcdf library is not thread-safe
+        lock = threading.Lock()
+
+        def read(var, year, block):
+            """Read one year and block of data from a variable"""
+            if var.dimensions[0] == txydim[0]:
+                years = slice(year*steps_per_year, (year+1)*steps_per_year)
+                block = (years,) + block
+            with lock:
+                return self._stage('read', var.__getitem__, block)
+
+        # find output time steps
+        if self.integration == 'analytic':
+            npts, offset = steps_per_year, 0.0
+        else:
+            npts, offset = self.interpolate_n, 0.5
+
         # create dimensions
-        ods.createDimension(txydim[0], self.interpolate_n)
+        ods.createDimension(txydim[0], nyears*npts)
+        if transient:
+            ods.createDimension('year', nyears)
         for dimname in xydim:
             ods.createDimension(dimname, len(ids.dimensions[dimname]))
 
@@ -437,10 +2145,7 @@ class PDDModel():
 
         # create time coordinate
         var = _create_nc_variable(ods, 'time', 'f4', txydim[0])
-        var[:] = (np.arange(self.interpolate_n)+0.5) / self.interpolate_n
-
-        # run PDD model
-        smb = self(temp, prec, stdv=stdv)
+        var[:] = (np.arange(nyears*npts)+offset) / npts
 
         # if output_variables was not defined, use output_size
         if output_variables is None:
@@ -449,22 +2154,239 @@ class PDDModel():
                 output_variables += ['accu', 'snow_melt', 'ice_melt', 'melt',
                                      'runoff']
             if output_size == 'big':
-                output_variables += ['temp', 'prec', 'stdv', 'inst_pdd',
-                                     'accu_rate', 'snow_melt_rate',
-                                     'ice_melt_rate', 'melt_rate',
-                                     'runoff_rate', 'inst_smb', 'snow_depth']
+                output_variables += INSTANTANEOUS
 
-        # write output variables
+        # create output variables
         for varname in output_variables:
-            if varname not in smb:
+            if varname in INSTANTANEOUS:
+                dim = txydim
+            elif transient:
+                dim = ('year',) + xydim
+            else:
+                dim = xydim
+            _create_nc_variable(ods, varname, 'f4', dim)
+
+        def items():
+            """Yield the mask, then input data for each year, in each block"""
+            for block in blocks:
+                yield None if maskvar is None else read(maskvar, 0, block) != 0
+                for year in range(nyears):
+                    temp = read(tempvar, year, block)
+                    prec = read(precvar, year, block)
+                    stdv = (0.0 if stdvvar is None else
+                            read(stdvvar, year, block))
+
+                    # convert to degC
+                    # TODO: handle unit conversion better
+                    if tempvar.units in ('K', 'Kelvin'):
+                        temp = temp - 273.15
+                    yield temp, prec, stdv
+
+        def write(block, year, results):
+            """Write output variables for one block and year"""
+            for varname in output_variables:
+                if varname in INSTANTANEOUS:
+                    index = (slice(year*npts, (year+1)*npts),) + block
+                elif transient:
+                    index = (year,) + block
+                else:
+                    index = block
+                # evaluate lazy results before taking the lock
+                array = results[varname]
+                with lock:
+                    self._stage('write', ods.variables[varname].__setitem__,
+                                index, array)
+
+        # for each block, run PDD model, year by year if transient, while
+        # reading and writing in background threads unless queue_size is 0,
+        # and sharing one pool of worker processes between all runs
+        with self._shared_pool(workers), _Pipeline(
+                items(), write, queue_size, self.hooks) as pipeline:
+            for block in blocks:
+                mask = pipeline.get()
+                years = (pipeline.get() for _ in range(nyears))
+                if transient:
+                    results = self.run_transient(years, workers=workers,
+                                                 outputs=output_variables,
+                                                 mask=mask)
+                else:
+                    results = [self(*next(years), workers=workers,
+                                    outputs=output_variables, mask=mask)]
+                for year, smb in enumerate(results):
+                    pipeline.put(block, year, smb)
+
+    def nco_batch(self, input_files, output_files, jobs=None, **kwargs):
+        """NetCDF operator for many files.
+
+        Run the netCDF operator on each pair of input and output files, in a
+        pool of *jobs* worker processes if larger than one. Each worker holds
+        a copy of the model for all its files, so that modules are imported
+        and interpolation operators computed only once per worker for files
+        sharing the same time axis. Failures are reported without
+        interrupting other files.
+
+        *input_files*: list of str
+            Names of input netCDF files.
+        *output_files*: list of str
+            Names of output netCDF files.
+        *jobs*: int
+            Number of worker processes, each processing one file at a time.
+        *kwargs*:
+            Other keyword arguments are passed to `nco`.
+
+        Yield (input_file, output_file, error, seconds) tuples as files are
+        completed, where error is None on success, or an error message.
+        """
+
+        # process files one by one in this process
+        if jobs is None or jobs <= 1:
+            for input_file, output_file in zip(input_files, output_files):
+                yield _batch_run(input_file, output_file, kwargs, model=self)
+            return
+
+        # otherwise process files in a pool of warm workers
+        with ProcessPoolExecutor(jobs, initializer=_batch_init,
+                                 initargs=(self,)) as pool:
+            futures = [pool.submit(_batch_run, input_file, output_file, kwargs)
+                       for input_file, output_file
+                       in zip(input_files, output_files)]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def apply_xarray(self, ds, output_variables=None, time_dim='time',
+                     initial_snow=0.0):
+        """Xarray operator.
+
+        Map the model over spatial chunks of an xarray Dataset, keeping time
+        as a single chunk. If the dataset is backed by dask arrays, nothing
+        is computed until results are, so that the model can be one stage of
+        a larger lazy computation, run in parallel and out-of-core by the
+        dask scheduler. Requires xarray, and dask for lazy evaluation.
+
+        *ds*: xarray.Dataset
+            Input dataset containing near-surface air temperature in variable
+            'temp', precipitation rate in variable 'prec', and optionally,
+            standard deviation of near-surface air temperature in variable
+            'stdv', interpreted as in `nco`. Variables without a time
+            dimension are interpreted as constant in time.
+        *output_variables*: list of str
+            List of output variables to compute. By default, compute the
+            number of positive degree days and total surface mass balance.
+        *time_dim*: str
+            Name of the time dimension.
+        *initial_snow*: float
+            Snow depth at the beginning of the year.
+
+        Return an xarray Dataset of output variables with attributes from
+        `ATTRIBUTES`. Instantaneous variables are given along a new time
+        coordinate of the same name.
+        """
+        import xarray as xr
+
+        # prepare input variables, converting temperature to degC
+        temp = ds['temp']
+        if temp.attrs.get('units') in ('K', 'Kelvin'):
+            temp = temp - 273.15
+        inputs = [temp, ds['prec']]
+        if 'stdv' in ds:
+            inputs.append(ds['stdv'])
+        inputs = [array.chunk({time_dim: -1})
+                  if array.chunks and time_dim in array.dims else array
+                  for array in inputs]
+
+        # check output variables and find output time steps
+        output_variables = list(output_variables or ['pdd', 'smb'])
+        for varname in output_variables:
+            if varname not in ATTRIBUTES or varname in ('x', 'y', 'time',
+                                                        'time_bounds'):
                 raise KeyError("%s is not a valid variable name" % varname)
-            dim = (txydim if smb[varname].ndim == 3 else xydim)
-            var = _create_nc_variable(ods, varname, 'f4', dim)
-            var[:] = smb[varname]
+        if self.integration == 'analytic':
+            npts, offset = ds.sizes[time_dim], 0.0
+        else:
+            npts, offset = self.interpolate_n, 0.5
+
+        def run(*arrays):
+            """Run the model on one block, with time as last dimension"""
+            arrays = [np.moveaxis(array, -1, 0)
+                      if core else array
+                      for array, core in zip(arrays, cores)]
+            results = self(*arrays, outputs=output_variables,
+                           initial_snow=initial_snow)
+            results = tuple(np.moveaxis(results[varname], 0, -1)
+                            if varname in INSTANTANEOUS else results[varname]
+                            for varname in output_variables)
+            return results if len(results) > 1 else results[0]
+
+        # map the model over spatial blocks, giving the size of the output
+        # time dimension only if an instantaneous variable is requested
+        cores = [time_dim in array.dims for array in inputs]
+        output_dims = [[time_dim] if varname in INSTANTANEOUS else []
+                       for varname in output_variables]
+        output_sizes = {time_dim: npts} if any(output_dims) else {}
+        results = xr.apply_ufunc(
+            run, *inputs,
+            input_core_dims=[[time_dim] if core else [] for core in cores],
+            output_core_dims=output_dims, exclude_dims={time_dim},
+            dask='parallelized',
+            output_dtypes=[np.dtype(self.dtype)]*len(output_variables),
+            dask_gufunc_kwargs={'output_sizes': output_sizes})
+        if len(output_variables) == 1:
+            results = (results,)
+
+        # assemble output dataset with attributes and time coordinate
+        out = xr.Dataset()
+        for varname, array in zip(output_variables, results):
+            if varname in INSTANTANEOUS:
+                array = array.transpose(time_dim, ...)
+            out[varname] = array.assign_attrs(ATTRIBUTES[varname])
+        if time_dim in out.dims:
+            attrs = {attr: value for attr, value in ATTRIBUTES['time'].items()
+                     if attr != 'bounds'}
+            out[time_dim] = xr.Variable(
+                time_dim, (np.arange(npts)+offset) / npts, attrs)
+        return out
+
+
+# Instrumentation
+# ---------------
+
+class Profiler():
+    """Return a hook recording wall time, array sizes and shapes of stages.
+
+    Append the instance to the `hooks` attribute of a `PDDModel` to record
+    each stage of subsequent model runs in the `records` attribute. Array
+    bytes are the size of arrays returned (or written) by each stage, not
+    memory allocated while computing it.
+    """
 
-        # close netcdf files
-        ids.close()
-        ods.close()
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, stage, seconds, array_bytes, shapes):
+        """Record one stage."""
+        self.records.append({'stage': stage, 'seconds': seconds,
+                             'array_bytes': array_bytes, 'shapes': shapes})
+
+    def summary(self):
+        """Return a table of number of calls, time and array size per stage."""
+        totals = collections.OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'], [0, 0.0, 0, None])
+            total[0] += 1
+            total[1] += record['seconds']
+            total[2] += record['array_bytes']
+            total[3] = record['shapes'][0] if record['shapes'] else None
+        lines = ['%-12s %8s %12s %12s  %s' % (
+            'stage', 'calls', 'seconds', 'array MiB', 'last shape')]
+        for stage, (calls, seconds, array_bytes, shape) in totals.items():
+            lines.append('%-12s %8d %12.6f %12.3f  %s' % (
+                stage, calls, seconds, array_bytes/2**20, shape))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Write records to a JSON file."""
+        with open(filename, 'w') as f:
+            json.dump(self.records, f, indent=2)
 
 
 # Command-line interface
@@ -524,16 +2446,21 @@ def make_fake_climate(filename):
 def main():
     """Main program for command-line execution."""
 
-    import argparse
-
     # parse arguments
     parser = argparse.ArgumentParser(
         description='A Python Positive Degree Day (PDD) model '
                     'for glacier surface mass balance.')
-    parser.add_argument('-i', '--input', metavar='input.nc',
+    parser.add_argument('-i', '--input', metavar='input.nc', nargs='+',
                         help='name of netCDF input file containing '
                              'air temperature (temp), precipitation (prec), '
-                             '[and temperature standard deviation (stdv)]')
+                             '[and temperature standard deviation (stdv)], '
+                             'or several files to process in batch mode')
+    parser.add_argument('-b', '--batch', metavar='inputs.txt',
+                        help='text file listing netCDF input files to '
+                             'process in batch mode, one per line')
+    parser.add_argument('-d', '--output-dir', metavar='DIR',
+                        help='directory for output files in batch mode, '
+                             'named after input files')
     parser.add_argument('-o', '--output', metavar='output.nc',
                         help='name of netCDF output file (default smb.nc)',
                         default='smb.nc')
@@ -582,6 +2509,65 @@ def main():
                         help='number of points used in interpolations '
                              '(default %s)' % PARAMETERS['interpolate_n'],
                         default=PARAMETERS['interpolate_n'])
+    parser.add_argument('--integration', metavar='I',
+                        help='method used to integrate pdd and accumulation '
+                             '(default %s)' % PARAMETERS['integration'],
+                        default=PARAMETERS['integration'],
+                        choices=('sampled', 'analytic'))
+    parser.add_argument('--backend', metavar='B',
+                        help='engine used for cumulative outputs '
+                             '(default %s)' % PARAMETERS['backend'],
+                        default=PARAMETERS['backend'],
+                        choices=('numpy', 'numba'))
+    parser.add_argument('--spinup', metavar='S',
+                        help='start from the periodic steady-state snow '
+                             'depth (default none)', choices=('periodic',))
+    parser.add_argument('--solver', metavar='S',
+                        help='method used to compute snow depth '
+                             '(default %s)' % PARAMETERS['solver'],
+                        default=PARAMETERS['solver'],
+                        choices=('loop', 'cumsum'))
+    parser.add_argument('--inst-pdd-method', metavar='M',
+                        help='method used to compute instantaneous pdd '
+                             '(default %s)' % PARAMETERS['inst_pdd_method'],
+                        default=PARAMETERS['inst_pdd_method'],
+                        choices=('exact', 'table'))
+    parser.add_argument('--inst-pdd-tolerance', metavar='TOL', type=float,
+                        help='maximum error of tabulated instantaneous pdd '
+                             '(default %s)' % PARAMETERS['inst_pdd_tolerance'],
+                        default=PARAMETERS['inst_pdd_tolerance'])
+    parser.add_argument('--dtype', metavar='T',
+                        help='floating-point type used in computations '
+                             '(default %s)' % PARAMETERS['dtype'],
+                        default=PARAMETERS['dtype'], choices=('f4', 'f8'))
+    parser.add_argument('--tile-size', type=int, metavar=('NX', 'NY'), nargs=2,
+                        help='run the model on spatial tiles of this size '
+                             'to limit memory usage (default no tiling)')
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                        help='directory for disk-backed output arrays, '
+                             'used with --tile-size (default in memory)')
+    parser.add_argument('--steps-per-year', type=int, metavar='N',
+                        help='run a transient simulation, interpreting the '
+                             'input time axis as years of N records each')
+    parser.add_argument('--block-size', type=int, metavar=('NX', 'NY'),
+                        nargs=2,
+                        help='read, compute and write spatial blocks of this '
+                             'size (default input chunk size or whole grid)')
+    parser.add_argument('--queue-size', type=int, metavar='N',
+                        help='number of blocks read ahead of and waiting to '
+                             'be written behind computation, 0 to disable '
+                             '(default 2)', default=2)
+    parser.add_argument('-m', '--mask', metavar='VAR',
+                        help='name of input variable flagging active cells '
+                             'with non-zero values (default all cells '
+                             'with valid input data)')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='-',
+                        help='print time and memory used by each stage of '
+                             'the model, or save records to a JSON file')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='number of parallel worker processes, used '
+                             'for separate files in batch mode (default 1)',
+                        default=1)
     args = parser.parse_args()
 
     # if asked, list output variables and exit
@@ -590,12 +2576,21 @@ def main():
         for varname, vardict in sorted(ATTRIBUTES.items()):
             if varname != 'time_bounds':
                 print('  %-16s %s' % (varname, vardict['long_name']))
-        import sys
         sys.exit()
 
+    # list input files for batch mode
+    input_files = list(args.input or [])
+    if args.batch:
+        with open(args.batch) as f:
+            input_files += [line.strip() for line in f if line.strip()]
+    batch = args.batch or len(input_files) > 1
+    if batch and not args.output_dir:
+        parser.error('batch mode requires -d/--output-dir')
+
     # if no input file was given, prepare a dummy one
-    if not args.input:
+    if not input_files:
         make_fake_climate('atm.nc')
+        input_files = ['atm.nc']
 
     # initiate PDD model
     pdd = PDDModel(pdd_factor_snow=args.pdd_factor_snow,
@@ -605,12 +2600,56 @@ def main():
                    temp_snow=args.temp_snow,
                    temp_rain=args.temp_rain,
                    interpolate_rule=args.interpolate_rule,
-                   interpolate_n=args.interpolate_n)
-
-    # compute surface mass balance
-    pdd.nco(args.input or 'atm.nc', args.output,
-            output_size=args.output_size,
-            output_variables=args.output_variables)
+                   interpolate_n=args.interpolate_n,
+                   integration=args.integration,
+                   backend=args.backend,
+                   spinup=args.spinup,
+                   solver=args.solver,
+                   inst_pdd_method=args.inst_pdd_method,
+                   inst_pdd_tolerance=args.inst_pdd_tolerance,
+                   dtype=args.dtype,
+                   tile_size=args.tile_size and tuple(args.tile_size),
+                   scratch_dir=args.scratch_dir)
+
+    # if asked, record time and memory used by each stage
+    if args.profile:
+        profiler = Profiler()
+        pdd.hooks.append(profiler)
+
+    # prepare netcdf operator arguments
+    kwargs = dict(output_size=args.output_size,
+                  output_variables=args.output_variables,
+                  steps_per_year=args.steps_per_year,
+                  block_size=args.block_size and tuple(args.block_size),
+                  mask_variable=args.mask,
+                  queue_size=args.queue_size)
+
+    # in batch mode, process files in parallel and report status
+    if batch:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_files = [os.path.join(args.output_dir, os.path.basename(f))
+                        for f in input_files]
+        failures = 0
+        for input_file, output_file, error, seconds in pdd.nco_batch(
+                input_files, output_files, jobs=args.jobs, **kwargs):
+            if error is None:
+                print('done   %s -> %s (%.2f s)'
+                      % (input_file, output_file, seconds))
+            else:
+                print('failed %s: %s' % (input_file, error))
+                failures += 1
+        if failures:
+            sys.exit('%d of %d files failed' % (failures, len(input_files)))
+
+    # otherwise compute surface mass balance for a single file
+    else:
+        pdd.nco(input_files[0], args.output, workers=args.jobs, **kwargs)
+
+    # print or save profile
+    if args.profile == '-':
+        print(profiler.summary())
+    elif args.profile:
+        profiler.dump(args.profile)
 
 
 if __name__ == '__main__':
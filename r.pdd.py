@@ -54,6 +54,13 @@ COPYRIGHT:   (c) 2013-2018 Julien Seguinot
 #% required: no
 #% multiple: yes
 #%end
+#%option
+#% key: mask
+#% type: string
+#% gisprompt: old,cell,raster
+#% description: Name of input raster map of active cells (non-zero)
+#% required: no
+#%end
 
 #%option
 #% key: pdd
@@ -155,10 +162,46 @@ COPYRIGHT:   (c) 2013-2018 Julien Seguinot
 #% required: no
 #%end
 
+#%option
+#% key: memory
+#% type: integer
+#% description: Maximum memory to be used (in MB)
+#% answer: 300
+#% required: no
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes used to read input maps
+#% answer: 1
+#% required: no
+#%end
+
+from concurrent.futures import ProcessPoolExecutor
 from grass.script import core as grass
-from grass.script import array as garray
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 import numpy as np          # scientific module Numpy [1]
-from pypdd import PDDModel  # positive degree day model PyPDD [2]
+from pypdd import PDDModel, CUMULATIVE  # positive degree day model PyPDD [2]
+
+
+### Helper functions ###
+
+def read_block(name, start, stop):
+    """Read a block of rows from a raster map, nulls as NaN"""
+    raster = RasterRow(name)
+    raster.open('r')
+    try:
+        block = np.array([raster[row] for row in range(start, stop)])
+        mtype = raster.mtype
+    finally:
+        raster.close()
+    if mtype == 'CELL':
+        null = block == np.iinfo('i4').min
+        block = block.astype('f8')
+        block[null] = np.nan
+    return block.astype('f8', copy=False)
 
 
 ### Main function ###
@@ -170,6 +213,7 @@ def main():
     temp_maps = options['temp'].split(',')
     prec_maps = options['prec'].split(',')
     stdv_maps = options['stdv'].split(',')
+    mask_maps = [options['mask']] if options['mask'] else []
 
     # check that we have compatible number of input maps
     ntemp = len(temp_maps)
@@ -181,64 +225,86 @@ def main():
     if nstdv not in (1, ntemp):
         grass.fatal('Got %i stdv maps, expected 1 (constant) or %i (as temp)'
                     % (nstdv, ntemp))
+    if stdv_maps == ['']:
+        stdv_maps = []
 
     # exit if no output is requested
-    out_vars = ['pdd', 'accu', 'snow_melt', 'ice_melt', 'melt', 'runoff', 'smb']
+    out_vars = CUMULATIVE[:-1]
     out_maps = {var: options[var] for var in out_vars if options[var] != ''}
     if len(out_maps) == 0:
         grass.fatal('No output required. Please inform at least one of ' +
                     ', '.join(out_vars) + '.')
 
-    # read temperature maps
-    grass.info('reading temperature maps...')
-    temp = [garray.array() for m in temp_maps]
-    for i, m in enumerate(temp_maps):
-        temp[i].read(m)
-        grass.percent(i, ntemp, 1)
-    temp = np.asarray(temp)
-
-    # read precipitation maps
-    grass.info('reading precipitation maps...')
-    prec = [garray.array() for m in temp_maps]
-    for i, m in enumerate(prec_maps):
-        prec[i].read(m)
-        grass.percent(i, nprec, 1)
-    prec = np.asarray(prec)
-
-    # read standard deviation maps
-    if stdv_maps != ['']:
-        grass.info('reading standard deviation maps...')
-        stdv = [garray.array() for m in stdv_maps]
-        for i, m in enumerate(stdv_maps):
-            stdv[i].read(m)
-            grass.percent(i, nstdv, 1)
-        stdv = np.asarray(stdv)
-    else:
-        stdv = 0.0
-
     # initialize PDD model
     pdd = PDDModel()
     for param in ('pdd_factor_snow', 'pdd_factor_ice',
-                  'refreeze_snow', 'refreeze_ice', 'temp_snow', 'temp_rain',
-                  'interpolate_rule', 'interpolate_n'):
+                  'refreeze_snow', 'refreeze_ice', 'temp_snow', 'temp_rain'):
         if options[param]:
             setattr(pdd, param, float(options[param]))
-    for param in ('interpolate_rule',):
-        if options[param]:
-            setattr(pdd, param, str(options[param]))
-
-    # run PDD model
-    grass.info('running PDD model...')
-    smb = pdd(temp, prec, stdv)
-
-    # write output maps
-    grass.info('writing output maps...')
-    for varname in ['pdd', 'accu', 'snow_melt', 'ice_melt', 'melt',
-                    'runoff', 'smb']:
-        if options[varname]:
-            a = garray.array()
-            a[:] = smb[varname]
-            a.write(mapname=options[varname])
+    if options['interpolate_rule']:
+        pdd.interpolate_rule = str(options['interpolate_rule'])
+    if options['interpolate_n']:
+        pdd.interpolate_n = int(options['interpolate_n'])
+
+    # compute number of rows per block from memory and map counts
+    region = Region()
+    nrows, ncols = region.rows, region.cols
+    nmaps = ntemp + nprec + len(stdv_maps) + len(mask_maps)
+    row_bytes = 8 * ncols * (nmaps + 2*len(out_maps) + 20)
+    block_rows = max(1, min(nrows, int(options['memory'])*2**20 // row_bytes))
+
+    # open output maps
+    in_maps = temp_maps + prec_maps + stdv_maps + mask_maps
+    out_rasters = {var: RasterRow(m) for var, m in out_maps.items()}
+    for raster in out_rasters.values():
+        raster.open('w', 'DCELL', overwrite=grass.overwrite())
+
+    # the grass library is not thread-safe, read input maps in separate
+    # processes, each opening its own copy of the maps, if requested
+    nprocs = max(1, int(options['nprocs']))
+    executor = ProcessPoolExecutor(nprocs) if nprocs > 1 else None
+    mapper = executor.map if executor else map
+
+    # process the region in blocks of rows
+    grass.info('running PDD model in blocks of %i rows...' % block_rows)
+    try:
+        for start in range(0, nrows, block_rows):
+            stop = min(start+block_rows, nrows)
+
+            # read input maps, in parallel if requested
+            blocks = list(mapper(read_block, in_maps, [start]*nmaps,
+                                 [stop]*nmaps))
+            temp = np.ma.masked_invalid(blocks[:ntemp])
+            prec = np.ma.masked_invalid(blocks[ntemp:ntemp+nprec])
+            if stdv_maps:
+                stdv = np.ma.masked_invalid(
+                    blocks[ntemp+nprec:ntemp+nprec+nstdv])
+            else:
+                stdv = 0.0
+
+            # read mask map, null input cells are always inactive
+            if mask_maps:
+                mask = np.nan_to_num(blocks[-1]) != 0
+            else:
+                mask = None
+
+            # run PDD model
+            smb = pdd(temp, prec, stdv, mask=mask, outputs=list(out_maps))
+
+            # write output rows
+            for varname, raster in out_rasters.items():
+                values = np.ma.filled(smb[varname], np.nan).astype('f8')
+                for row in values:
+                    raster.put_row(Buffer(row.shape, mtype='DCELL',
+                                          buffer=row))
+            grass.percent(stop, nrows, 1)
+
+    # stop reading processes and close output maps
+    finally:
+        if executor:
+            executor.shutdown()
+        for raster in out_rasters.values():
+            raster.close()
 
 
 ### Main program ###
@@ -20,7 +20,9 @@ setuptools.setup(
     url='http://github.com/juseg/aftershocks',
     license='gpl-3.0',
     install_requires=['numpy', 'scipy'],
-    extras_require = {'NetCDF interface': 'netCDF4'},
+    extras_require = {'NetCDF interface': 'netCDF4',
+                      'Compiled backend': 'numba',
+                      'xarray interface': ['xarray', 'dask']},
     py_modules=['pypdd'],
     scripts=['pypdd.py'],
 )
@@ -0,0 +1,54 @@
+# Copyright (c) 2013--2018, Julien Seguinot <seguinot@vaw.baug.ethz.ch>
+# GNU General Public License v3.0+ (https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Tests for the compiled backend and its NumPy fallback."""
+
+import sys
+
+import numpy as np
+import pytest
+
+import pypdd
+
+
+def make_inputs(stdv, dtype='f8'):
+    """Return random temperature, precipitation and standard deviation."""
+    rng = np.random.default_rng(0)
+    temp = rng.normal(-2, 8, (12, 11, 17)).astype(dtype)
+    prec = rng.uniform(0, 2, (12, 11, 17)).astype(dtype)
+    if stdv == 'spatial':
+        stdv = rng.uniform(0, 4, (11, 17)).astype(dtype)
+        stdv[::3] = 0
+    return temp, prec, stdv
+
+
+@pytest.mark.parametrize('stdv,dtype,rtol', [
+    (0.0, 'f8', 1e-10), (2.0, 'f8', 1e-10), ('spatial', 'f8', 1e-10),
+    ('spatial', 'f4', 1e-4)])
+def test_numba_agrees_with_numpy(stdv, dtype, rtol):
+    """Check that both backends compute the same cumulative outputs."""
+    pytest.importorskip('numba')
+    inputs = make_inputs(stdv, dtype)
+    kwargs = dict(refreeze_snow=0.3, refreeze_ice=0.1, dtype=dtype)
+    expected = pypdd.PDDModel(backend='numpy', **kwargs)(
+        *inputs, outputs=pypdd.CUMULATIVE, initial_snow=0.5)
+    results = pypdd.PDDModel(backend='numba', **kwargs)(
+        *inputs, outputs=pypdd.CUMULATIVE, initial_snow=0.5)
+    for varname in pypdd.CUMULATIVE:
+        assert results[varname].dtype == expected[varname].dtype
+        np.testing.assert_allclose(results[varname], expected[varname],
+                                   rtol=rtol, atol=rtol, err_msg=varname)
+
+
+def test_fallback_without_numba(monkeypatch):
+    """Check that a missing numba falls back to numpy with a warning."""
+    monkeypatch.setitem(sys.modules, 'numba', None)
+    pypdd._numba_kernel.cache_clear()
+    inputs = make_inputs('spatial')
+    outputs = pypdd.CUMULATIVE
+    expected = pypdd.PDDModel(backend='numpy')(*inputs, outputs=outputs)
+    with pytest.warns(UserWarning, match='Numba not found'):
+        results = pypdd.PDDModel(backend='numba')(*inputs, outputs=outputs)
+    for varname in pypdd.CUMULATIVE:
+        np.testing.assert_array_equal(results[varname], expected[varname])
+    pypdd._numba_kernel.cache_clear()
@@ -0,0 +1,40 @@
+# Copyright (c) 2013--2018, Julien Seguinot <seguinot@vaw.baug.ethz.ch>
+# GNU General Public License v3.0+ (https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Tests for the xarray operator."""
+
+import numpy as np
+import pytest
+
+import pypdd
+
+xr = pytest.importorskip('xarray')
+pytest.importorskip('dask')
+
+
+def make_dataset():
+    """Return a synthetic climate dataset chunked in space and time."""
+    rng = np.random.default_rng(0)
+    temp = rng.normal(-2, 8, (12, 11, 17))
+    prec = rng.uniform(0, 2, (12, 11, 17))
+    stdv = rng.uniform(0, 4, (11, 17))
+    ds = xr.Dataset({'temp': (('time', 'x', 'y'), temp+273.15,
+                              {'units': 'K'}),
+                     'prec': (('time', 'x', 'y'), prec),
+                     'stdv': (('x', 'y'), stdv)})
+    return ds.chunk({'time': 3, 'x': 4, 'y': 5}), (temp, prec, stdv)
+
+
+@pytest.mark.parametrize('output_variables', [
+    None, ['smb'], ['pdd', 'melt', 'runoff'], ['pdd', 'inst_pdd'],
+    ['snow_depth']])
+def test_chunked_dataset(output_variables):
+    """Check chunked results against a direct model run."""
+    ds, inputs = make_dataset()
+    pdd = pypdd.PDDModel()
+    out = pdd.apply_xarray(ds, output_variables=output_variables)
+    expected = pdd(*inputs)
+    for varname in output_variables or ['pdd', 'smb']:
+        assert out[varname].chunks is not None
+        np.testing.assert_allclose(out[varname].values, expected[varname],
+                                   rtol=1e-12, atol=1e-12, err_msg=varname)